@@ -1,17 +1,19 @@
 #!/usr/bin/python
 
 class BGPmessage:
-    def __init__(self, ts, msgtype):
+    def __init__(self, ts, msgtype, rib=False):
         #self.next_hop = None
-        #self.source = None
+        self.source = None
+        # part of a RIB dump, not a BGP update as received
+        self.rib = rib
         self.timestamp = ts
         self.type = msgtype
         self.aspath = []
         self.announce = []
         self.withdraw = []
 
-    #def set_source(self, src):
-    #    self.source = src
+    def set_source(self, src):
+        self.source = src
 
     #def set_nexthop(self, hop):
     #    self.next_hop = hop
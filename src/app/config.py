@@ -1,5 +1,12 @@
 DATABASE_TYPE = "mongodb"
 DATABASE_CONN = "mongodb://localhost:27017/rpki-read"
+DATABASE_POOL_SIZE = 10
+METADATA_CACHE_TTL = 60
+LIST_MAX_LIMIT = 1000
 BGP_SOURCE = "NA"
 UPDATE_INTERVAL_STATS = 17
 UPDATE_INTERVAL_FACTOR = 19
+STATS_CACHE_FILE = "/tmp/rpki-read-stats.json"
+STATS_LOCK_FILE = "/tmp/rpki-read-stats.lock"
+# snapshot stored by snapshot.py --refresh, None to read stats from the database
+SNAPSHOT_FILE = None
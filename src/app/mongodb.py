@@ -1,112 +1,125 @@
 """
 """
 import logging
+import os
+import re
+import threading
+import time
 
 from datetime import datetime
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from netaddr import IPNetwork
 
-def get_ipversion_stats(dbconnstr):
-    """ generate ip version specific stats from database """
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
-    if "validity_latest" not in database.collection_names() or \
-            database.validity_latest.count() == 0:
-        return None, None
-    types = ['num_', 'ips_']
-    # init ipv4 stats
-    ipv4_stats = dict()
-    for t in types:
-        ipv4_stats[t+'Valid'] = 0
-        ipv4_stats[t+'InvalidAS'] = 0
-        ipv4_stats[t+'InvalidLength'] = 0
-        ipv4_stats[t+'NotFound'] = 0
-    ipv4_stats['pfx_Valid'] = []
-    ipv4_stats['pfx_InvalidAS'] = []
-    ipv4_stats['pfx_InvalidLength'] = []
-    ipv4_stats['pfx_NotFound'] = []
-    # init ipv6 stats
-    ipv6_stats = dict()
-    for t in types:
-        ipv6_stats[t+'Valid'] = 0
-        ipv6_stats[t+'InvalidAS'] = 0
-        ipv6_stats[t+'InvalidLength'] = 0
-        ipv6_stats[t+'NotFound'] = 0
-    ipv6_stats['pfx_Valid'] = []
-    ipv6_stats['pfx_InvalidAS'] = []
-    ipv6_stats['pfx_InvalidLength'] = []
-    ipv6_stats['pfx_NotFound'] = []
+import config
+# states as defined by the backend, the archive encodes them by index
+from vrptable import VALIDITY_STATES, ARCHIVE_STATES
+try:
+    from snapshot import Snapshot
+except ImportError:
+    Snapshot = None
+
+STATS_RESOLUTIONS = ['minute', 'hour', 'day']
+
+LIST_SORT_FIELDS = {'prefix': 'prefix',
+                    'origin': 'value.validated_route.route.origin_asn',
+                    'state': 'value.validated_route.validity.state'}
+
+g_clients = dict()
+g_clients_pid = None
+g_metadata = dict()
+g_clients_lock = threading.Lock()
+g_snapshot = {'mtime': None, 'snapshot': None}
+g_snapshot_lock = threading.Lock()
+
+def _get_database(dbconnstr):
+    """ database of a process-wide pooled client, the client is created
+    lazily, i.e., after mod_wsgi forked its worker processes """
+    global g_clients_pid
+    with g_clients_lock:
+        if g_clients_pid != os.getpid():
+            g_clients.clear()
+            g_metadata.clear()
+            g_clients_pid = os.getpid()
+        if dbconnstr not in g_clients:
+            g_clients[dbconnstr] = MongoClient(dbconnstr,
+                                               maxPoolSize=config.DATABASE_POOL_SIZE,
+                                               connect=False)
+        client = g_clients[dbconnstr]
+    return client.get_default_database()
 
+def _has_documents(database, collection):
+    """ check if collection exists and is not empty, cached for
+    METADATA_CACHE_TTL seconds """
+    key = (database.name, collection)
+    now = time.time()
+    cached = g_metadata.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    has_documents = database[collection].find_one({}, {'_id': 1}) is not None
+    g_metadata[key] = (has_documents, now + config.METADATA_CACHE_TTL)
+    return has_documents
+
+def _get_ipversion_data(rollup, bits):
+    """ stats of an address family from its rollup, the address space per
+    state is derived from the prefix length histogram """
+    stats = dict()
+    for state in VALIDITY_STATES:
+        hist = rollup['len_'+state]
+        stats['num_'+state] = rollup['num_'+state]
+        stats['len_'+state] = hist
+        stats['ips_'+state] = sum(count << (bits - length)
+                                  for length, count in enumerate(hist))
+    return stats
+
+def _get_snapshot():
+    """ columnar snapshot of the latest results in SNAPSHOT_FILE, as stored
+    by the backend, reloaded whenever the file changes """
+    path = getattr(config, 'SNAPSHOT_FILE', None)
+    if (Snapshot is None) or (path is None):
+        return None
     try:
-        pipeline = [{"$group": {
-            "_id": '$value.validated_route.route.prefix',
-            "origins": {"$push": {
-                "asn": "$value.validated_route.route.origin_asn",
-                "validity": "$value.validated_route.validity.state"}}
-        }}]
-        results = list(database.validity_latest.aggregate(pipeline, allowDiskUse=True))
-        # parse results
-        for res in results:
-            if res['_id'] is None:
-                logging.debug("emtpy record, skipping")
-                continue
-            ipn = IPNetwork(res['_id'])
-            b_val = {"Valid": False,
-                     "InvalidLength": False,
-                     "InvalidAS": False,
-                     "NotFound": False}
-            if ipn.version == 4:
-                for asn in res['origins']:
-                    if "num_"+asn['validity'] in ipv4_stats:
-                        ipv4_stats["num_"+asn['validity']] += 1
-                    else:
-                        ipv4_stats["num_"+asn['validity']] = 1
-                    b_val[asn['validity']] = True
-                if b_val['Valid']:
-                    ipv4_stats["ips_Valid"] += ipn.size
-                    ipv4_stats["pfx_Valid"].append(ipn.prefixlen)
-                elif b_val['InvalidLength']:
-                    ipv4_stats["ips_InvalidLength"] += ipn.size
-                    ipv4_stats["pfx_InvalidLength"].append(ipn.prefixlen)
-                elif b_val['InvalidAS']:
-                    ipv4_stats["ips_InvalidAS"] += ipn.size
-                    ipv4_stats["pfx_InvalidAS"].append(ipn.prefixlen)
-                elif b_val['NotFound']:
-                    ipv4_stats["ips_NotFound"] += ipn.size
-                    ipv4_stats["pfx_NotFound"].append(ipn.prefixlen)
-            elif ipn.version == 6:
-                for asn in res['origins']:
-                    if "num_"+asn['validity'] in ipv6_stats:
-                        ipv6_stats["num_"+asn['validity']] += 1
-                    else:
-                        ipv6_stats["num_"+asn['validity']] = 1
-                    b_val[asn['validity']] = True
-                if b_val['Valid']:
-                    ipv6_stats["ips_Valid"] += ipn.size
-                    ipv6_stats["pfx_Valid"].append(ipn.prefixlen)
-                elif b_val['InvalidLength']:
-                    ipv6_stats["ips_InvalidLength"] += ipn.size
-                    ipv6_stats["pfx_InvalidLength"].append(ipn.prefixlen)
-                elif b_val['InvalidAS']:
-                    ipv6_stats["ips_InvalidAS"] += ipn.size
-                    ipv6_stats["pfx_InvalidAS"].append(ipn.prefixlen)
-                elif b_val['NotFound']:
-                    ipv6_stats["ips_NotFound"] += ipn.size
-                    ipv6_stats["pfx_NotFound"].append(ipn.prefixlen)
-                # end if b_val
-            # end if ip.version
-        # end for results
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with g_snapshot_lock:
+        if mtime != g_snapshot['mtime']:
+            try:
+                g_snapshot['snapshot'] = Snapshot.load(path)
+            except Exception as errmsg:
+                logging.exception("load snapshot, error: " + str(errmsg))
+                g_snapshot['snapshot'] = None
+            g_snapshot['mtime'] = mtime
+        return g_snapshot['snapshot']
+
+def get_ipversion_stats(dbconnstr):
+    """ ip version specific stats, computed from the snapshot if configured,
+    otherwise read from the rollup maintained by the backend """
+    snapshot = _get_snapshot()
+    if snapshot is not None:
+        try:
+            rollup = snapshot.stats()
+            return _get_ipversion_data(rollup['ipv4'], 32), \
+                _get_ipversion_data(rollup['ipv6'], 128)
+        except Exception as errmsg:
+            logging.exception("get_ipversion_stats from snapshot, error: " + str(errmsg))
+        # end try
+    database = _get_database(dbconnstr)
+    ipv4_stats = None
+    ipv6_stats = None
+    try:
+        rollup = database.validity_rollup.find_one({'_id': 'ipversion'})
+        if rollup is not None:
+            ipv4_stats = _get_ipversion_data(rollup['ipv4'], 32)
+            ipv6_stats = _get_ipversion_data(rollup['ipv6'], 128)
     except Exception as errmsg:
         logging.exception("get_ipversion_stats, error: " + str(errmsg))
         ipv4_stats = None
         ipv6_stats = None
-        # end try
-    # end if
+    # end try
     return ipv4_stats, ipv6_stats
 
 def get_dash_stats(dbconnstr):
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
+    database = _get_database(dbconnstr)
     # init stats results
     stats = dict()
     stats['latest_dt'] = 'now'
@@ -116,19 +129,16 @@ def get_dash_stats(dbconnstr):
     stats['num_InvalidLength'] = 0
     stats['num_NotFound'] = 0
     stats['num_Total'] = 0
-    if "validity_latest" in database.collection_names() and database.validity_latest.count() > 0:
+    if _has_documents(database, "validity_stats"):
         try:
-            pipeline = [
-                {"$match": {'value.type': 'announcement'}},
-                {"$group": {"_id": "$value.validated_route.validity.state", "count": {"$sum": 1}}}
-            ]
-            results = list(database.validity_latest.aggregate(pipeline, allowDiskUse=True))
-            for i in range(0, len(results)):
-                stats["num_"+results[i]['_id']] = results[i]['count']
-                stats['num_Total'] += results[i]['count']
-            stats['latest_ts'] = database.validity_latest.find_one(
-                projection={'value.timestamp': True, '_id': False},
-                sort=[('value.timestamp', DESCENDING)])['value']['timestamp']
+            # latest sample of the stats maintained by the backend
+            checkpoint = database.validity_stats.find_one(
+                {'res': STATS_RESOLUTIONS[0]},
+                projection={'_id': False}, sort=[('ts', DESCENDING)])
+            for state in VALIDITY_STATES:
+                stats['num_' + state] = checkpoint.get('num_' + state, 0)
+                stats['num_Total'] += stats['num_' + state]
+            stats['latest_ts'] = checkpoint['last_ts']
             stats['latest_dt'] = datetime.fromtimestamp(
                 int(stats['latest_ts'])).strftime('%Y-%m-%d %H:%M:%S')
         except Exception as errmsg:
@@ -138,17 +148,32 @@ def get_dash_stats(dbconnstr):
     # end if
     return stats
 
+def get_stats_series(dbconnstr, begin, end, resolution='hour'):
+    """ time series of stats between begin and end timestamp, one point per
+    bucket of the given resolution, values are averages over the bucket """
+    database = _get_database(dbconnstr)
+    if resolution not in STATS_RESOLUTIONS:
+        raise ValueError('Invalid resolution: ' + str(resolution))
+    series = list()
+    results = database.validity_stats.find(
+        {'res': resolution, 'ts': {'$gte': int(begin), '$lte': int(end)}},
+        {'_id': 0}).sort('ts', ASCENDING)
+    for res in results:
+        point = {'ts': res['ts']}
+        for state in VALIDITY_STATES:
+            point['num_' + state] = int(round(float(res.get('sum_' + state, 0)) /
+                                              max(1, res.get('count', 0))))
+        series.append(point)
+    return series
+
 def get_last24h_stats(dbconnstr, latest_ts):
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
+    database = _get_database(dbconnstr)
 
     last24h = None
-    if "validity_stats" in database.collection_names() and database.validity_stats.count() > 0:
+    if _has_documents(database, "validity_stats"):
         try:
             ts24 = int(latest_ts) - (3600*24) # last 24h
-            last24h = list(database.validity_stats.find(
-                {'ts': {'$gt': ts24}},
-                {'_id':0}).sort('ts', DESCENDING))
+            last24h = get_stats_series(dbconnstr, ts24 + 1, latest_ts, STATS_RESOLUTIONS[0])
         except Exception as errmsg:
             logging.exception("get_last24h_stats, error: " + str(errmsg))
             last24h = None
@@ -156,15 +181,46 @@ def get_last24h_stats(dbconnstr, latest_ts):
     # end if
     return last24h
 
-def get_validation_list(dbconnstr, state):
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
+def _get_list_filter(state, search):
+    """ query for results in given state, optionally filtered by an origin
+    ASN, an IP prefix (matching itself and more specifics) or a prefix string """
+    query = {'value.validated_route.validity.state' : state}
+    if search:
+        search = search.strip()
+        if search.upper().startswith('AS'):
+            query['value.validated_route.route.origin_asn'] = 'AS' + search[2:]
+        else:
+            try:
+                ipn = IPNetwork(search).cidr
+            except Exception:
+                query['prefix'] = {'$regex': '^' + re.escape(search)}
+            else:
+                width = 8 if ipn.version == 4 else 32
+                query['range.afi'] = ipn.version
+                query['range.lo'] = {'$gte': '%0*x' % (width, ipn.first),
+                                     '$lte': '%0*x' % (width, ipn.last)}
+                query['range.len'] = {'$gte': ipn.prefixlen}
+    return query
+
+def get_validation_list(dbconnstr, state, offset=0, limit=None,
+                        sort='prefix', order='asc', search=None):
+    """ one page of latest validation results in given state, returns the
+    total number of matching results and the page """
+    database = _get_database(dbconnstr)
+    total = 0
     rlist = []
-    if "validity_latest" in database.collection_names() and database.validity_latest.count() > 0:
+    if _has_documents(database, "validity_latest"):
         try:
+            query = _get_list_filter(state, search)
+            sort_field = LIST_SORT_FIELDS.get(sort, 'prefix')
+            direction = DESCENDING if order == 'desc' else ASCENDING
+            total = database.validity_latest.count(query)
             results = database.validity_latest.find(
-                {'value.validated_route.validity.state' : state},
-                {'_id' : 0, 'value.type' : 0, 'value.timestamp' : 0})
+                query,
+                {'_id' : 0, 'value.type' : 0, 'value.timestamp' : 0},
+                sort=[(sort_field, direction)],
+                skip=max(0, offset),
+                limit=min(limit or config.LIST_MAX_LIMIT, config.LIST_MAX_LIMIT))
             for res in results:
                 data = dict()
                 data['prefix'] = res['value']['validated_route']['route']['prefix']
@@ -174,29 +230,52 @@ def get_validation_list(dbconnstr, state):
                 rlist.append(data)
         except Exception as errmsg:
             logging.exception("get_validation_list, error: " + str(errmsg))
-    return rlist
+    return total, rlist
+
+def _get_origin(search_string):
+    """ normalize an AS number to its stored form, i.e., AS65000 """
+    return 'AS' + search_string.strip()[2:].strip()
+
+def get_origin_summary(dbconnstr, search_string):
+    """ number of routes per state and invalid prefixes of an origin AS, as
+    maintained by the backend """
+    summary = None
+    database = _get_database(dbconnstr)
+    try:
+        summary = database.origin_summary.find_one({'_id': _get_origin(search_string)})
+    except Exception as errmsg:
+        logging.exception("get_origin_summary failed with: " + str(errmsg))
+    return summary
 
-def get_validation_origin(dbconnstr, search_string):
+def get_validation_origin(dbconnstr, search_string, offset=0, limit=None,
+                          sort='prefix', order='asc', search=None):
+    """ one page of latest validation results of an origin AS, optionally
+    filtered by a prefix string, returns the total number of results and
+    the page """
+    total = 0
     rlist = None
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
-    if "validity_latest" in database.collection_names() and database.validity_latest.count() > 0:
+    database = _get_database(dbconnstr)
+    if _has_documents(database, "validity_latest"):
         try:
-            pipeline = [
-                {"$match": {'value.validated_route.route.origin_asn': search_string}}
-            ]
-#            tmp_list = db.validity_latest.find(
-#                {'value.validated_route.route.origin_asn' : search_string},
-#                {'_id' : 0, 'value.type' : 0, 'value.timestamp' : 0})
-            results = list(database.validity_latest.aggregate(pipeline, allowDiskUse=True))
+            query = {'origin': _get_origin(search_string)}
+            if search:
+                query['prefix'] = {'$regex': '^' + re.escape(search.strip())}
+            sort_field = LIST_SORT_FIELDS.get(sort, 'prefix')
+            direction = DESCENDING if order == 'desc' else ASCENDING
+            total = database.validity_latest.count(query)
+            results = database.validity_latest.find(
+                query,
+                sort=[(sort_field, direction)],
+                skip=max(0, offset),
+                limit=min(limit or config.LIST_MAX_LIMIT, config.LIST_MAX_LIMIT))
         except Exception as errmsg:
             logging.exception("get_validation_origin failed with: " + str(errmsg))
         else:
             rlist = list()
             for res in results:
                 data = dict()
-                data['prefix'] = res['value']['validated_route']['route']['prefix']
-                data['origin'] = res['value']['validated_route']['route']['origin_asn']
+                data['prefix'] = res['prefix']
+                data['origin'] = res['origin']
                 if res['value']['type'] == 'announcement':
                     data['state'] = res['value']['validated_route']['validity']['state']
                     data['roas'] = res['value']['validated_route']['validity']['VRPs']
@@ -206,73 +285,129 @@ def get_validation_origin(dbconnstr, search_string):
                 rlist.append(data)
         # end try
     # end if
-    return rlist
+    return total, rlist
+
+def _get_prefix_data(res):
+    """ format a validity_latest document as search result """
+    data = dict()
+    data['prefix'] = res['prefix']
+    data['origin'] = res['origin']
+    data['timestamp'] = res['value']['timestamp']
+    data['type'] = res['value']['type']
+    if data['type'] == 'announcement':
+        data['state'] = res['value']['validated_route']['validity']['state']
+        data['roas'] = res['value']['validated_route']['validity']['VRPs']
+    else:
+        data['state'] = 'withdraw'
+    return data
+
+def _get_covering_candidates(ipn):
+    """ all prefixes covering IPNetwork ipn, including ipn itself """
+    candidates = [str(ipn.cidr)]
+    candidates.extend([str(sup) for sup in ipn.cidr.supernet(0)])
+    return candidates
+
+def _find_covering(database, ipn):
+    """ validity_latest documents of all routes covering ipn, longest prefix
+    first, a single indexed lookup of at most 33 (IPv4) or 129 (IPv6) prefixes """
+    results = list(database.validity_latest.find(
+        {'prefix': {'$in': _get_covering_candidates(ipn)}}))
+    results.sort(key=lambda res: IPNetwork(res['prefix']).prefixlen, reverse=True)
+    return results
 
 def get_validation_prefix(dbconnstr, search_string):
-    prefix = None
-    result = None
+    """ latest validation results of all routes of the longest prefix matching
+    the searched IP address """
+    rlist = None
     try:
         ipa = IPNetwork(search_string).ip
     except Exception as errmsg:
         logging.exception("IP address parse failed with: " + str(errmsg))
     else:
-        client = MongoClient(dbconnstr)
-        database = client.get_default_database()
-        while prefix is None:
-            try:
-                results = list(database.validity_latest.find({}, {'_id': 1}))
-                prefix = IPNetwork("0.0.0.0/0")
-                for res in results:
-                    ipp = IPNetwork(res['_id'])
-                    if (ipa in ipp) and (ipp.prefixlen > prefix.prefixlen):
-                        prefix = ipp
-            except Exception as errmsg:
-                logging.exception("SEARCH failed with: " + str(errmsg))
-                prefix = None
-            # end try
-        # end while
+        database = _get_database(dbconnstr)
         try:
-            results = list(database.validity_latest.find({'_id': str(prefix)}))
-            rlist = list()
-            for res in results:
-                data = dict()
-                data['prefix'] = res['_id']
-                data['timestamp'] = res['value']['timestamp']
-                data['type'] = res['value']['type']
-                if data['type'] == 'announcement':
-                    data['origin'] = res['value']['validated_route']['route']['origin_asn']
-                    data['state'] = res['value']['validated_route']['validity']['state']
-                    data['roas'] = res['value']['validated_route']['validity']['VRPs']
-                else:
-                    data['state'] = 'withdraw'
-                rlist.append(data)
+            results = _find_covering(database, IPNetwork(str(ipa)))
+            rlist = [_get_prefix_data(res) for res in results
+                     if res['prefix'] == results[0]['prefix']]
         except Exception as errmsg:
             logging.exception("SEARCH failed with: " + str(errmsg))
             rlist = None
         # end try
     return rlist
 
-def get_validation_history(dbconnstr, search_prefix):
+def get_covering_prefixes(dbconnstr, search_string):
+    """ latest validation results of all prefixes covering the searched
+    prefix, longest first """
+    rlist = None
+    try:
+        ipn = IPNetwork(search_string)
+    except Exception as errmsg:
+        logging.exception("IP prefix parse failed with: " + str(errmsg))
+    else:
+        database = _get_database(dbconnstr)
+        try:
+            rlist = [_get_prefix_data(res) for res in _find_covering(database, ipn)]
+        except Exception as errmsg:
+            logging.exception("SEARCH failed with: " + str(errmsg))
+        # end try
+    return rlist
+
+def get_more_specific_prefixes(dbconnstr, search_string):
+    """ latest validation results of all prefixes covered by the searched
+    prefix, including itself, using the address range index """
+    rlist = None
+    try:
+        ipn = IPNetwork(search_string).cidr
+    except Exception as errmsg:
+        logging.exception("IP prefix parse failed with: " + str(errmsg))
+    else:
+        width = 8 if ipn.version == 4 else 32
+        database = _get_database(dbconnstr)
+        try:
+            results = database.validity_latest.find(
+                {'range.afi': ipn.version,
+                 'range.lo': {'$gte': '%0*x' % (width, ipn.first),
+                              '$lte': '%0*x' % (width, ipn.last)},
+                 'range.len': {'$gte': ipn.prefixlen}},
+                sort=[('range.lo', ASCENDING)])
+            rlist = [_get_prefix_data(res) for res in results]
+        except Exception as errmsg:
+            logging.exception("SEARCH failed with: " + str(errmsg))
+        # end try
+    return rlist
+
+def get_validation_history(dbconnstr, search_prefix, begin=None, end=None):
+    """ validity state transitions of all origins of a prefix, newest first,
+    optionally limited to a range of timestamps """
     rlist = list()
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
+    database = _get_database(dbconnstr)
+    query = {'prefix': search_prefix}
+    base = dict()
+    if begin is not None:
+        # transitions are stored per month
+        base['$gt'] = int(begin) - 31*24*3600
+    if end is not None:
+        base['$lte'] = int(end)
+    if base:
+        query['base'] = base
     try:
-        results = database.archive.find(
-            {'prefix': search_prefix},
-            {'_id': 0},
-            sort=[('timestamp', DESCENDING)])
+        results = database.validity_archive.find(
+            query, {'_id': 0}, sort=[('base', DESCENDING)])
         for res in results:
-            data = dict()
-            data['prefix'] = res['prefix']
-            data['timestamp'] = res['timestamp']
-            data['type'] = res['type']
-            if data['type'] == 'announcement':
-                data['origin'] = res['validated_route']['route']['origin_asn']
-                data['state'] = res['validated_route']['validity']['state']
-                data['roas'] = res['validated_route']['validity']['VRPs']
-            else:
-                data['state'] = 'withdraw'
-            rlist.append(data)
+            for event in res['e']:
+                data = dict()
+                data['prefix'] = res['prefix']
+                data['origin'] = res['origin']
+                data['timestamp'] = res['base'] + (event >> 3)
+                data['state'] = ARCHIVE_STATES[event & 7]
+                if data['state'] == 'withdraw':
+                    data['type'] = 'withdraw'
+                else:
+                    data['type'] = 'announcement'
+                if (begin is None or data['timestamp'] >= begin) and \
+                        (end is None or data['timestamp'] <= end):
+                    rlist.append(data)
     except Exception as errmsg:
         logging.exception("SEARCH failed with: " + str(errmsg))
+    rlist.sort(key=lambda data: data['timestamp'], reverse=True)
     return rlist
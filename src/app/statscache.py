@@ -0,0 +1,86 @@
+"""
+Stats shared by all processes of the web frontend. A single updater is
+elected by an exclusive lock on a lock file, it computes the stats and
+publishes them as JSON file, replaced atomically by a rename. All processes
+read the stats from that file and reload it whenever it changes.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+
+class StatsCache(object):
+    """
+    Snapshot of the stats as published in `path`. A loaded snapshot is never
+    modified, i.e., updates replace it as a whole, such that readers can use
+    it without locking or copying.
+    """
+    def __init__(self, path, lock_path, default):
+        self.path = path
+        self.lock_path = lock_path
+        self.default = default
+        self.stats = default
+        self.mtime = None
+        self.lock_file = None
+        self.lock = threading.Lock()
+
+    def is_updater(self):
+        """
+        Try to become the updater, once elected a process keeps the lock
+        until it exits and another process takes over
+        """
+        if self.lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            lock_file.close()
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        logging.info("stats cache, elected as updater, pid " + str(os.getpid()))
+        self.lock_file = lock_file
+        return True
+
+    def get(self):
+        """
+        Returns the latest snapshot, reloads the file if it has changed
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return self.stats
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    try:
+                        with open(self.path) as stats_file:
+                            self.stats = json.load(stats_file)
+                    except (IOError, ValueError) as errmsg:
+                        logging.warning("stats cache, load failed with: " + str(errmsg))
+                    else:
+                        self.mtime = mtime
+        return self.stats
+
+    def publish(self, stats):
+        """
+        Write snapshot to a temporary file next to the stats file and move
+        it in place, readers see either the old or the new snapshot
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        prefix='.stats')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(stats, tmp_file, separators=(',', ':'))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.stats = stats
+            self.mtime = os.stat(self.path).st_mtime
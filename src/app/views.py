@@ -2,12 +2,10 @@
 """
 import atexit
 import codecs
-from copy import deepcopy
 import gc
 import json
 import logging
 import sys
-import threading
 import time
 
 import markdown
@@ -16,6 +14,7 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from flask import render_template, Markup, request
 
 from app import app
+from statscache import StatsCache
 
 import config
 if config.DATABASE_TYPE == 'mongodb':
@@ -24,9 +23,9 @@ else:
     logging.critical("unknown database type!")
     sys.exit(1)
 
-g_stats = {'dash': {}, 'l24h': [], 'ipv4': {}, 'ipv6': {}}
+g_stats = StatsCache(config.STATS_CACHE_FILE, config.STATS_LOCK_FILE,
+                     {'dash': {}, 'l24h': [], 'ipv4': {}, 'ipv6': {}})
 g_stats_counter = config.UPDATE_INTERVAL_FACTOR
-g_lock = threading.Lock()
 
 #----- helper functions -----#
 def _is_prefix(ipstr):
@@ -44,14 +43,30 @@ def _is_asn(asnstr):
         return True
     return False
 
+def _get_page_args():
+    """ paging parameters as sent by bootstrap-table """
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', config.LIST_MAX_LIMIT))
+    except ValueError:
+        offset = 0
+        limit = config.LIST_MAX_LIMIT
+    return offset, limit
+
 def _get_table_json(state):
-    """ return state table ass JSON """
-    dlist = get_validation_list(config.DATABASE_CONN, state)
+    """ return one page of the state table as JSON, paging, sorting and
+    filtering parameters as sent by bootstrap-table """
+    offset, limit = _get_page_args()
+    total, dlist = get_validation_list(config.DATABASE_CONN, state,
+                                       offset=offset, limit=limit,
+                                       sort=request.args.get('sort', 'prefix'),
+                                       order=request.args.get('order', 'asc'),
+                                       search=request.args.get('search'))
     data = dict()
-    data['total'] = len(dlist)
+    data['total'] = total
     data['state'] = state
     data['rows'] = dlist
-    return json.dumps(dlist, indent=2, separators=(',', ': '))
+    return json.dumps(data, separators=(',', ':'))
 
 #----- update functions -----#
 def update_dash_stats():
@@ -74,11 +89,11 @@ def update_dash_stats():
                 (float(dash_stats['num_NotFound'])/float(dash_stats['num_Total']))*100, 2)
     return dash_stats
 
-def update_last24h_stats():
+def update_last24h_stats(dash_stats):
     """ update stats over last 24h """
     last24h_stats = None
     try:
-        lts = g_stats['dash']['latest_ts']
+        lts = dash_stats.get('latest_ts', 0)
         if lts == 0:
             lts = int(time.time())
         last24h_stats = get_last24h_stats(config.DATABASE_CONN, lts)
@@ -97,28 +112,35 @@ def update_ipversion_stats():
     return ipv4_stats, ipv6_stats
 
 def update_stats():
-    """ update all stats """
-    global g_stats, g_stats_counter, g_lock
+    """ update all stats, only done by the elected updater process """
+    global g_stats, g_stats_counter
+    try:
+        if not g_stats.is_updater():
+            return
+    except Exception as errmsg:
+        logging.exception("update_stats, lock failed with: " + str(errmsg))
+        return
     g_stats_counter += 1
+    stats = dict(g_stats.get())
     dash_stats = update_dash_stats()
     if dash_stats != None:
-        with g_lock:
-            g_stats['dash'] = dash_stats
+        stats['dash'] = dash_stats
     # end if
     if g_stats_counter > config.UPDATE_INTERVAL_FACTOR:
         g_stats_counter = 0
-        l24h_stats = update_last24h_stats()
+        l24h_stats = update_last24h_stats(stats['dash'])
         ipv4_stats, ipv6_stats = update_ipversion_stats()
         if l24h_stats != None:
-            with g_lock:
-                g_stats['l24h'] = l24h_stats
+            stats['l24h'] = l24h_stats
         if ipv4_stats != None:
-            with g_lock:
-                g_stats['ipv4'] = ipv4_stats
+            stats['ipv4'] = ipv4_stats
         if ipv6_stats != None:
-            with g_lock:
-                g_stats['ipv6'] = ipv6_stats
+            stats['ipv6'] = ipv6_stats
     # end if g_stats_counter
+    try:
+        g_stats.publish(stats)
+    except Exception as errmsg:
+        logging.exception("update_stats, publish failed with: " + str(errmsg))
     gc.collect()
 
 @app.before_first_request
@@ -156,31 +178,24 @@ def about():
 @app.route('/dashboard')
 @app.route('/search', methods=['GET'])
 def dashboard():
-    global g_lock
-    lstats = {}
-    with g_lock:
-        if g_stats['dash'] != None:
-            lstats = deepcopy(g_stats['dash'])
-    # end lock
+    lstats = g_stats.get()['dash']
     return render_template("dashboard.html", stats=lstats)
 
 ## stats handler
 @app.route('/stats')
 def stats():
-    global g_lock
+    gstats = g_stats.get()
     lstats = dict()
-    with g_lock:
-        # ipv4 origin stats
-        if ('num_NotFound' in g_stats['ipv4']) and (g_stats['ipv4']['num_NotFound'] > 0):
-            lstats['ipv4'] = '1'
-            lstats['ipv4_data'] = deepcopy(g_stats['ipv4'])
-        if ('num_NotFound' in g_stats['ipv6']) and (g_stats['ipv6']['num_NotFound'] > 0):
-            lstats['ipv6'] = '1'
-            lstats['ipv6_data'] = deepcopy(g_stats['ipv6'])
-        lstats['latest_dt'] = deepcopy(g_stats['dash']['latest_dt'])
-        lstats['source'] = deepcopy(g_stats['dash']['source'])
-        lstats['last24h'] = deepcopy(g_stats['l24h'])
-    # end lock
+    # ipv4 origin stats
+    if ('num_NotFound' in gstats['ipv4']) and (gstats['ipv4']['num_NotFound'] > 0):
+        lstats['ipv4'] = '1'
+        lstats['ipv4_data'] = gstats['ipv4']
+    if ('num_NotFound' in gstats['ipv6']) and (gstats['ipv6']['num_NotFound'] > 0):
+        lstats['ipv6'] = '1'
+        lstats['ipv6_data'] = gstats['ipv6']
+    lstats['latest_dt'] = gstats['dash'].get('latest_dt')
+    lstats['source'] = gstats['dash'].get('source')
+    lstats['last24h'] = gstats['l24h']
     return render_template("stats.html", stats=lstats)
 
 ## table handler
@@ -202,8 +217,14 @@ def invalid_len():
 ## search handler
 @app.route('/search', methods=['POST'])
 def search():
-    config_json = {'url' : '/search_json?search='+request.form['query'],
-                   'color' : 'default', 'query' : request.form['query']}
+    query = request.form['query']
+    config_json = {'url' : '/search_json?search='+query,
+                   'color' : 'default', 'query' : query}
+    if _is_asn(query):
+        # results of an origin AS are paged by the server
+        config_json['url'] = '/origin_json?asn='+query
+        config_json['paged'] = True
+        config_json['summary'] = get_origin_summary(config.DATABASE_CONN, query)
     return render_template("search.html", config=config_json)
 
 ## table data as json
@@ -219,13 +240,64 @@ def invalid_as_json():
 def invalid_len_table_json():
     return _get_table_json('InvalidLength')
 
+@app.route('/origin_json', methods=['GET'])
+def origin_json():
+    offset, limit = _get_page_args()
+    total, dlist = get_validation_origin(config.DATABASE_CONN, request.args.get('asn', ''),
+                                         offset=offset, limit=limit,
+                                         sort=request.args.get('sort', 'prefix'),
+                                         order=request.args.get('order', 'asc'),
+                                         search=request.args.get('search'))
+    data = dict()
+    data['total'] = total
+    data['rows'] = dlist or []
+    return json.dumps(data, separators=(',', ':'))
+
+@app.route('/stats_json', methods=['GET'])
+def stats_json():
+    """ stats time series, range as begin and end timestamp, default is the
+    last 30 days before the latest results, in hour resolution """
+    latest_ts = g_stats.get()['dash'].get('latest_ts') or int(time.time())
+    try:
+        end = int(request.args.get('end', latest_ts))
+        begin = int(request.args.get('begin', end - 30*24*3600))
+        series = get_stats_series(config.DATABASE_CONN, begin, end,
+                                  request.args.get('res', 'hour'))
+    except ValueError as errmsg:
+        return json.dumps({'error': str(errmsg)}), 400
+    return json.dumps(series, separators=(',', ':'))
+
+@app.route('/history_json', methods=['GET'])
+def history_json():
+    """ archived validity state transitions of all origins of a prefix,
+    optionally limited to a range as begin and end timestamp """
+    prefix = request.args.get('prefix', '')
+    if not _is_prefix(prefix):
+        return json.dumps({'error': 'invalid prefix: ' + prefix}), 400
+    try:
+        begin = request.args.get('begin')
+        end = request.args.get('end')
+        history = get_validation_history(config.DATABASE_CONN, prefix,
+                                         int(begin) if begin is not None else None,
+                                         int(end) if end is not None else None)
+    except ValueError as errmsg:
+        return json.dumps({'error': str(errmsg)}), 400
+    return json.dumps(history, separators=(',', ':'))
+
 @app.route('/search_json', methods=['GET'])
 def search_json():
     query = request.args.get('search')
+    scope = request.args.get('scope', 'best')
+    validity_now = None
     if _is_prefix(query):
-        validity_now = get_validation_prefix(config.DATABASE_CONN, query)
+        if scope == 'covering':
+            validity_now = get_covering_prefixes(config.DATABASE_CONN, query)
+        elif scope == 'more-specific':
+            validity_now = get_more_specific_prefixes(config.DATABASE_CONN, query)
+        else:
+            validity_now = get_validation_prefix(config.DATABASE_CONN, query)
     elif _is_asn(query):
-        validity_now = get_validation_origin(config.DATABASE_CONN, query)
+        validity_now = get_validation_origin(config.DATABASE_CONN, query)[1]
     ret = list()
     if validity_now != None:
         ret.extend(validity_now)
@@ -2,20 +2,27 @@
 from __future__ import print_function
 
 import argparse
-import json
 import logging
-import re
 import socket
 import sys
 import time
 
 import multiprocessing as mp
 import xml.etree.ElementTree as ET
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
-from settings import DEFAULT_LOG_LEVEL, DEFAULT_BGPMON_SERVER
+from settings import DEFAULT_LOG_LEVEL, DEFAULT_BGPMON_SERVER, \
+                     BGPMON_RECV_BUFSIZE, BGPMON_RATE_INTERVAL, \
+                     BGPMON_PARSERS, BGPMON_PARSE_BATCH, WIRE_FORMAT, WIRE_FLUSH_INTERVAL, \
+                     BUFFER_SIZE
 from BGPmessage import BGPmessage
+from buffers import StageBuffer
+from wire import WireWriter, WIRE_FORMATS
 
-def parse_bgp_message(xml):
+def parse_bgp_message(xml, rib=False):
     """
     Returns a dict of a parsed BGP XML update message
     """
@@ -60,8 +67,10 @@ def parse_bgp_message(xml):
         return None
 
     # init return struct
-    bgp_message = BGPmessage(ts,'update')
-    #bgp_message.set_source(src_peer)
+    bgp_message = BGPmessage(ts,'update', rib)
+    src_addr = src.find('{urn:ietf:params:xml:ns:bgp_monitor}ADDRESS')
+    if src_addr is not None:
+        bgp_message.set_source(src_addr.text)
 
     # add withdrawn prefixes
     withdraws = update.findall('.//{urn:ietf:params:xml:ns:xfb}WITHDRAW')
@@ -88,6 +97,116 @@ def parse_bgp_message(xml):
 
     return bgp_message
 
+class BGPmonStreamFramer(object):
+    """
+    Splits the BGPmon XML stream into complete messages. Each received byte
+    is searched only once and the buffer only holds the incomplete tail, so
+    framing a message costs O(message size).
+    """
+    END_TAG = b'</BGP_MONITOR_MESSAGE>'
+
+    def __init__(self):
+        self.buffer = b''
+        self.scan = 0
+
+    def feed(self, data):
+        """
+        Add received data, returns list of complete messages
+        """
+        self.buffer += data
+        messages = list()
+        start = 0
+        while True:
+            end = self.buffer.find(self.END_TAG, max(start, self.scan))
+            if end < 0:
+                break
+            end += len(self.END_TAG)
+            messages.append(self.buffer[start:end].replace(b'<xml>', b''))
+            start = end
+        self.buffer = self.buffer[start:]
+        # the end tag may be split across two chunks
+        self.scan = max(0, len(self.buffer) - len(self.END_TAG) + 1)
+        return messages
+
+class MessageRate(object):
+    """
+    Count messages and log throughput every BGPMON_RATE_INTERVAL seconds
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.begin = time.time()
+
+    def add(self, num):
+        self.count += num
+        now = time.time()
+        if now - self.begin >= BGPMON_RATE_INTERVAL:
+            logging.info(self.name + ": " +
+                         str(round(self.count / (now - self.begin), 1)) + " msg/s")
+            self.count = 0
+            self.begin = now
+
+class InlineParser(object):
+    """
+    Parse received messages in the receiving process
+    """
+    def __init__(self, queue, stream):
+        self.queue = queue
+        self.rib = stream == 'rib'
+
+    def add(self, msg):
+        result = parse_bgp_message(msg, self.rib)
+        if result:
+            self.queue.put(result)
+
+    def flush(self):
+        pass
+
+class ParseDispatcher(object):
+    """
+    Hand received messages in numbered batches to the parser pool, the
+    output process restores the order of the batches per stream.
+    """
+    def __init__(self, parse_queue, stream):
+        self.parse_queue = parse_queue
+        self.stream = stream
+        self.seq = 0
+        self.batch = list()
+
+    def add(self, msg):
+        self.batch.append(msg)
+        if len(self.batch) >= BGPMON_PARSE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) > 0:
+            self.parse_queue.put((self.stream, self.seq, self.batch))
+            self.seq += 1
+            self.batch = list()
+
+def _get_parser(queue, parse_queue, stream):
+    if parse_queue is None:
+        return InlineParser(queue, stream)
+    return ParseDispatcher(parse_queue, stream)
+
+def parse_worker(parse_queue, queue):
+    """
+    Parse batches of raw XML messages from the receivers
+    """
+    logging.info ("CALL parse_worker")
+    while True:
+        batch = parse_queue.get()
+        if batch == 'STOP':
+            break
+        stream, seq, messages = batch
+        results = list()
+        for msg in messages:
+            result = parse_bgp_message(msg, stream == 'rib')
+            if result:
+                results.append(result)
+        queue.put((stream, seq, results))
+    return True
+
 def _init_bgpmon_sock(host, port):
     """
     Init bgpmon socket connections
@@ -98,6 +217,7 @@ def _init_bgpmon_sock(host, port):
     timeout = 0
     while not ready:
         bm_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        bm_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BGPMON_RECV_BUFSIZE)
         try:
             bm_sock.connect((host,port))
         except:
@@ -111,94 +231,106 @@ def _init_bgpmon_sock(host, port):
             ready = True
     return bm_sock
 
-def recv_bgpmon_rib(host, port, queue):
+def recv_bgpmon_rib(host, port, queue, parse_queue=None):
     """
     Receive and parse the BGP RIB XML stream of bgpmon
     """
     logging.info ("CALL recv_bgpmon_rib (%s:%d)", host, port)
     # open connection
     sock = _init_bgpmon_sock(host,port)
-    data = ""
-    stream = ""
+    framer = BGPmonStreamFramer()
+    parser = _get_parser(queue, parse_queue, 'rib')
+    rate = MessageRate("XML RIB stream")
     # receive data
     run = True
     parse = False
     logging.info(" + receiving XML RIB stream ...")
     while(run):
-        data = sock.recv(1024)
+        data = sock.recv(BGPMON_RECV_BUFSIZE)
         if not data:
             sock.close()
             time.sleep(60)
             sock = _init_bgpmon_sock(host,port)
+            framer = BGPmonStreamFramer()
             continue
 
-        stream += data
-        stream = str.replace(stream, "<xml>", "")
-        while (re.search('</BGP_MONITOR_MESSAGE>', stream)):
-            messages = stream.split('</BGP_MONITOR_MESSAGE>')
-            msg = messages[0] + '</BGP_MONITOR_MESSAGE>'
+        messages = framer.feed(data)
+        for msg in messages:
             # stop RIB parsing after TABLE_STOP message
-            if re.search('TABLE_STOP', msg):
+            if b'TABLE_STOP' in msg:
                 logging.info("found TABLE_STOP in XML RIB stream.")
                 parse = False
-            stream = '</BGP_MONITOR_MESSAGE>'.join(messages[1:])
             # parse RIB message if parsing is enabled
             if parse:
-                result = parse_bgp_message(msg)
-                if result:
-                    queue.put(result)
+                parser.add(msg)
             # start RIB parsing after TABLE_START message
-            elif re.search('TABLE_START', msg):
+            elif b'TABLE_START' in msg:
                 logging.info("found TABLE_START in XML RIB stream.")
                 parse = True
+        parser.flush()
+        rate.add(len(messages))
 
     sock.close()
     return True
 
-def recv_bgpmon_updates(host, port, queue):
+def recv_bgpmon_updates(host, port, queue, parse_queue=None):
     """
     Receive and parse the BGP update XML stream of bgpmon
     """
     logging.info ("CALL recv_bgpmon_updates (%s:%d)", host, port)
     # open connection
     sock = _init_bgpmon_sock(host,port)
-    data = ""
-    stream = ""
+    framer = BGPmonStreamFramer()
+    parser = _get_parser(queue, parse_queue, 'update')
+    rate = MessageRate("XML update stream")
     # receive data
     logging.info(" + receiving XML update stream ...")
     while(True):
-        data = sock.recv(1024)
+        data = sock.recv(BGPMON_RECV_BUFSIZE)
         if not data:
             sock.close()
             time.sleep(60)
             sock = _init_bgpmon_sock(host,port)
+            framer = BGPmonStreamFramer()
             continue
-        stream += data
-        stream = str.replace(stream, "<xml>", "")
-        while (re.search('</BGP_MONITOR_MESSAGE>', stream)):
-            messages = stream.split('</BGP_MONITOR_MESSAGE>')
-            msg = messages[0] + '</BGP_MONITOR_MESSAGE>'
-            stream = '</BGP_MONITOR_MESSAGE>'.join(messages[1:])
-            result = parse_bgp_message(msg)
-            if result:
-                queue.put(result)
+        messages = framer.feed(data)
+        for msg in messages:
+            parser.add(msg)
+        parser.flush()
+        rate.add(len(messages))
     return True
 
-def output(queue):
+def output(queue, wire_format='json'):
     """
     Output parsed BGP messages as JSON to STDOUT
     """
     logging.info ("CALL output")
+    writer = WireWriter(sys.stdout, wire_format)
+    # batches of the parser pool are held back until all previous batches
+    # of their stream have been written
+    next_seq = dict()
+    held = dict()
     run = True
     while run is True:
-        odata = queue.get()
+        try:
+            odata = queue.get(timeout=WIRE_FLUSH_INTERVAL)
+        except Empty:
+            writer.flush()
+            continue
         if (odata == 'STOP'):
-            print(odata)
+            writer.write(odata)
             run = False
+        elif isinstance(odata, tuple):
+            stream, seq, results = odata
+            held[(stream, seq)] = results
+            while (stream, next_seq.get(stream, 0)) in held:
+                for result in held.pop((stream, next_seq.get(stream, 0))):
+                    writer.write(result.__dict__)
+                next_seq[stream] = next_seq.get(stream, 0) + 1
         else:
-            print(json.dumps(odata.__dict__))
+            writer.write(odata.__dict__)
         # end if
-        sys.stdout.flush()
+    writer.flush()
     # end while
     return True
 
@@ -219,6 +351,16 @@ def main():
     parser.add_argument('-r', '--ribport',
                         help='Port of BGPmon RIB XML stream.',
                         type=int, default=DEFAULT_BGPMON_SERVER['rport'])
+    parser.add_argument('-n', '--parsers',
+                        help='Number of XML parser processes, 0 to parse in the receivers.',
+                        type=int, default=BGPMON_PARSERS)
+    parser.add_argument('-s', '--buffer-size',
+                        help='Number of buffered records per stage, a full buffer '
+                        + 'stops reading from BGPmon.',
+                        type=int, default=BUFFER_SIZE)
+    parser.add_argument('--wire',
+                        help='Encoding of output records.',
+                        choices=WIRE_FORMATS, default=WIRE_FORMAT)
     args = vars(parser.parse_args())
 
     numeric_level = getattr(logging, args['loglevel'].upper(), None)
@@ -232,23 +374,38 @@ def main():
 
     logging.info("START")
 
-    output_queue = mp.Queue()
+    output_queue = StageBuffer('parser output', args['buffer_size'])
+    parse_queue = None
+    pts = list()
+    if args['parsers'] > 0:
+        # batches of BGPMON_PARSE_BATCH messages
+        parse_queue = StageBuffer('parser input',
+                                  max(1, args['buffer_size'] // BGPMON_PARSE_BATCH))
+        for _ in range(args['parsers']):
+            pts.append(mp.Process(target=parse_worker,
+                                  args=(parse_queue.reader(), output_queue)))
     ot = mp.Process(target=output,
-                    args=(output_queue,))
+                    args=(output_queue.reader(), args['wire']))
     rt = mp.Process(target=recv_bgpmon_rib,
-                    args=(addr,args['ribport'], output_queue))
+                    args=(addr,args['ribport'], output_queue, parse_queue))
     try:
         ot.start()
+        for pt in pts:
+            pt.start()
         if args['ribport'] > 0:
             rt.start()
-        recv_bgpmon_updates(addr,port,output_queue)
+        recv_bgpmon_updates(addr,port,output_queue,parse_queue)
     except KeyboardInterrupt:
         logging.exception ("ABORT")
     finally:
+        if args['ribport'] > 0:
+            rt.terminate()
+        for pt in pts:
+            parse_queue.put("STOP")
+        for pt in pts:
+            pt.join()
         output_queue.put("STOP")
 
-    if args['ribport'] > 0:
-        rt.terminate()
     ot.join()
     logging.info("FINISH")
     # END
@@ -5,15 +5,21 @@ import argparse
 import gc
 import json
 import logging
+import os
 import sys
+import tempfile
 import time
 
+import multiprocessing as mp
 from datetime import datetime
 from _pybgpstream import BGPStream, BGPRecord, BGPElem
 
-from settings import MAX_COUNTER, DEFAULT_BGPSTREAM_COLLECTOR, DEFAULT_LOG_LEVEL, RIB_TS_INTERVAL
+from settings import MAX_COUNTER, DEFAULT_BGPSTREAM_COLLECTOR, DEFAULT_LOG_LEVEL, RIB_TS_INTERVAL, \
+                     WIRE_FORMAT, REPLAY_SHARD_INTERVAL, REPLAY_WORKERS
 from BGPmessage import BGPmessage
+from wire import WireWriter, WIRE_FORMATS
 output_counter = 0
+output_writer = None
 
 # helper functions
 def valid_date(s):
@@ -32,32 +38,45 @@ def output(odata):
     """
     global output_counter
     if odata == 'STOP':
-        print(odata)
+        output_writer.write(odata)
     elif odata == 'FLUSH':
-        sys.stdout.flush()
+        output_writer.flush()
     else:
-        print(json.dumps(odata.__dict__))
+        output_writer.write(odata.__dict__)
         output_counter += 1
     # end if
     if output_counter > MAX_COUNTER:
         output_counter = 0
-        sys.stdout.flush()
+        output_writer.flush()
         gc.collect()
 
-def recv_bgpstream_rib(begin, until, collector):
+def _start_stream(begin, until, collector, rib_file=None, upd_file=None):
+    """
+    Start a bgpstream of a collector, or of local MRT files instead
+    """
+    stream = BGPStream()
+    if (rib_file is not None) or (upd_file is not None):
+        stream.set_data_interface('singlefile')
+        if rib_file is not None:
+            stream.set_data_interface_option('singlefile', 'rib-file', rib_file)
+        if upd_file is not None:
+            stream.set_data_interface_option('singlefile', 'upd-file', upd_file)
+    else:
+        stream.add_filter('collector', collector)
+        stream.add_filter('record-type','updates')
+    stream.add_interval_filter(begin, until)
+    # Start the stream
+    stream.start()
+    return stream
+
+def recv_bgpstream_rib(begin, until, collector, rib_file=None):
     """
     Receive and parse BGP RIB records from a given bgpstream collector.
     """
     logging.info ("CALL recv_bgpstream_rib")
     # Create bgpstream
-    stream = BGPStream()
+    stream = _start_stream(begin, until, collector, rib_file=rib_file)
     rec = BGPRecord()
-    # set filtering
-    stream.add_filter('collector', collector)
-    stream.add_filter('record-type','updates')
-    stream.add_interval_filter(begin,until)
-    # Start the stream
-    stream.start()
     while (stream.get_next_record(rec)):
         if rec.status == 'valid':
             elem = rec.get_next_elem()
@@ -67,7 +86,8 @@ def recv_bgpstream_rib(begin, until, collector):
         bgp_message = None
         while (elem):
             if (elem.type.upper() == 'A') or (elem.type.upper() == 'R'):
-                bgp_message = BGPmessage(elem.time, 'update')
+                bgp_message = BGPmessage(elem.time, 'update', True)
+                bgp_message.set_source(elem.peer_address)
                 aspath = elem.fields['as-path'].split()
                 for a in aspath:
                     if not '{' in a: # ignore AS-SETs
@@ -79,20 +99,14 @@ def recv_bgpstream_rib(begin, until, collector):
     # end while (stream...)
     output('FLUSH')
 
-def recv_bgpstream_updates(begin, until, collector):
+def recv_bgpstream_updates(begin, until, collector, upd_file=None):
     """
     Receive and parse BGP update records from a given bgpstream collector
     """
     logging.info ("CALL recv_bgpstream_updates")
     # Create bgpstream
-    stream = BGPStream()
+    stream = _start_stream(begin, until, collector, upd_file=upd_file)
     rec = BGPRecord()
-    # set filtering
-    stream.add_filter('collector', collector)
-    stream.add_filter('record-type','updates')
-    stream.add_interval_filter(begin, until)
-    # Start the stream
-    stream.start()
     while (stream.get_next_record(rec)):
         if rec.status == 'valid':
             elem = rec.get_next_elem()
@@ -103,6 +117,7 @@ def recv_bgpstream_updates(begin, until, collector):
         while (elem):
             logging.info(" -- Record Element Type: " + elem.type + ", TS: " + str(elem.time))
             bgp_message = BGPmessage(elem.time, 'update')
+            bgp_message.set_source(elem.peer_address)
             if elem.type.upper() == 'A':
                 bgp_message.add_announce(elem.fields['prefix'])
                 aspath = elem.fields['as-path'].split()
@@ -117,6 +132,117 @@ def recv_bgpstream_updates(begin, until, collector):
         # end while (elem)
     # end while (stream...)
 
+def _get_shards(ts_begin, ts_until, interval):
+    """
+    Split replay into shards (index, begin, until), shard 0 is the RIB
+    before begin, followed by the updates in intervals of given seconds
+    """
+    shards = [(0, ts_begin - RIB_TS_INTERVAL, ts_begin)]
+    for begin in range(ts_begin, ts_until, interval):
+        shards.append((len(shards), begin, min(begin + interval, ts_until)))
+    return shards
+
+def _get_shard_path(shard_dir, index):
+    return os.path.join(shard_dir, 'shard-%06d.json' % index)
+
+def _save_checkpoint(path, checkpoint):
+    """
+    Replace checkpoint file atomically
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.replay')
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(checkpoint, tmp_file, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def replay_shard(task):
+    """
+    Parse a shard of the replay into a shard file, runs in a worker process.
+    The file is written under a temporary name and renamed when complete.
+    """
+    global output_writer
+    (index, begin, until), collector, rib_file, upd_file, shard_dir = task
+    path = _get_shard_path(shard_dir, index)
+    with open(path + '.tmp', 'w') as shard_file:
+        output_writer = WireWriter(shard_file, 'json', autoflush=False)
+        # interval filter of bgpstream includes until
+        if index == 0:
+            recv_bgpstream_rib(begin, until - 1, collector, rib_file)
+        else:
+            recv_bgpstream_updates(begin, until - 1, collector, upd_file)
+        output('FLUSH')
+    os.rename(path + '.tmp', path)
+    return index
+
+def _emit_shard(path):
+    """
+    Output records of a shard file and remove it
+    """
+    with open(path) as shard_file:
+        for line in shard_file:
+            output_writer.write(json.loads(line))
+    output('FLUSH')
+    os.remove(path)
+
+def replay(ts_begin, ts_until, collector, checkpoint_path, interval=REPLAY_SHARD_INTERVAL,
+           workers=REPLAY_WORKERS, rib_file=None, upd_file=None):
+    """
+    Replay a time range, shards are parsed in parallel by a pool of worker
+    processes and output in order, i.e., ordered by timestamp. Parsed and
+    output shards are recorded in the checkpoint file, such that an
+    interrupted replay resumes with the missing shards.
+    """
+    logging.info("CALL replay")
+    checkpoint = {'collector': collector, 'begin': ts_begin, 'until': ts_until,
+                  'interval': interval, 'done': [], 'emitted': []}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        for key in ('collector', 'begin', 'until', 'interval'):
+            if saved.get(key) != checkpoint[key]:
+                raise ValueError('Replay does not match checkpoint ' + checkpoint_path +
+                                 ', ' + key + ': ' + str(saved.get(key)))
+        checkpoint = saved
+        logging.info("resume replay, " + str(len(checkpoint['emitted'])) + " shards done")
+    shard_dir = os.path.splitext(checkpoint_path)[0] + '.d'
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    shards = _get_shards(ts_begin, ts_until, interval)
+    done = set(index for index in checkpoint['done']
+               if os.path.exists(_get_shard_path(shard_dir, index)))
+    emitted = set(checkpoint['emitted'])
+    tasks = [(shard, collector, rib_file, upd_file, shard_dir) for shard in shards
+             if (shard[0] not in emitted) and (shard[0] not in done)]
+    logging.info("replay " + str(len(tasks)) + " of " + str(len(shards)) + " shards")
+    pool = mp.Pool(max(1, workers))
+    try:
+        results = pool.imap_unordered(replay_shard, tasks)
+        next_index = 0
+        while True:
+            # output completed shards in order
+            while next_index < len(shards):
+                if next_index in emitted:
+                    next_index += 1
+                elif next_index in done:
+                    _emit_shard(_get_shard_path(shard_dir, next_index))
+                    emitted.add(next_index)
+                    checkpoint['emitted'] = sorted(emitted)
+                    _save_checkpoint(checkpoint_path, checkpoint)
+                    next_index += 1
+                else:
+                    break
+            if next_index >= len(shards):
+                break
+            index = next(results)
+            done.add(index)
+            checkpoint['done'] = sorted(done)
+            _save_checkpoint(checkpoint_path, checkpoint)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    logging.info("replay finished")
+
 def main():
     """
     The main loop, parsing arguments and start input and output threads loop
@@ -134,6 +260,25 @@ def main():
     parser.add_argument('-l', '--loglevel',
                         help='Set loglevel [DEBUG,INFO,WARNING,ERROR,CRITICAL].',
                         type=str, default=DEFAULT_LOG_LEVEL)
+    parser.add_argument('--wire',
+                        help='Encoding of output records.',
+                        choices=WIRE_FORMATS, default=WIRE_FORMAT)
+    parser.add_argument('--rib-file',
+                        help='Read RIB records from a local MRT file instead of the collector.',
+                        type=str, default=None)
+    parser.add_argument('--upd-file',
+                        help='Read update records from a local MRT file instead of the collector.',
+                        type=str, default=None)
+    parser.add_argument('-r', '--replay',
+                        help='Replay begin to until in parallel shards, resumes from '
+                        + 'the given checkpoint file.',
+                        type=str, default=None)
+    parser.add_argument('-s', '--shard',
+                        help='Length of replay shards in seconds.',
+                        type=int, default=REPLAY_SHARD_INTERVAL)
+    parser.add_argument('-w', '--workers',
+                        help='Number of replay worker processes.',
+                        type=int, default=REPLAY_WORKERS)
     args = vars(parser.parse_args())
 
     numeric_level = getattr(logging, args['loglevel'].upper(), None)
@@ -141,6 +286,8 @@ def main():
         raise ValueError('Invalid log level: %s' % loglevel)
     logging.basicConfig(level=numeric_level,
                         format='%(asctime)s : %(levelname)s : %(message)s')
+    global output_writer
+    output_writer = WireWriter(sys.stdout, args['wire'], autoflush=False)
     # parse and init timestamps
     dt_begin = args['begin']
     ts_begin = int(time.mktime(dt_begin.timetuple()))
@@ -150,11 +297,18 @@ def main():
         ts_until = int(time.mktime(dt_until.timetuple()))
     # start
     logging.info("START (" + str(ts_begin) + " - " + str(ts_until) + ")")
+    if args['replay'] and ts_until <= ts_begin:
+        parser.error('replay requires until after begin')
     try:
-        # receive last full RIB first
-        recv_bgpstream_rib((ts_begin - RIB_TS_INTERVAL), ts_begin, args['collector'])
-        # receive updates
-        recv_bgpstream_updates(ts_begin, ts_until, args['collector'])
+        if args['replay']:
+            replay(ts_begin, ts_until, args['collector'], args['replay'],
+                   max(1, args['shard']), args['workers'], args['rib_file'], args['upd_file'])
+        else:
+            # receive last full RIB first
+            recv_bgpstream_rib((ts_begin - RIB_TS_INTERVAL), ts_begin, args['collector'],
+                               args['rib_file'])
+            # receive updates
+            recv_bgpstream_updates(ts_begin, ts_until, args['collector'], args['upd_file'])
     except KeyboardInterrupt:
         logging.exception("ABORT")
     finally:
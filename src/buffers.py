@@ -0,0 +1,264 @@
+"""
+Bounded buffers between the stages of the backend. A full buffer blocks the
+producer, such that a slow stage throttles its upstream instead of queueing
+without limit. For streams of updates other policies can be set:
+
+ - drop-oldest: discard the oldest buffered record
+ - coalesce: keep only the latest of overflowing records with the same key
+ - spill: move overflowing records to a temporary file on disk
+
+Records put with keep set, e.g., of a RIB dump, are never dropped or
+coalesced, they are buffered as with policy block.
+
+Depth, high-water-mark and counters of each buffer are logged periodically.
+"""
+import json
+import logging
+import pickle
+import struct
+import tempfile
+import threading
+import time
+
+import multiprocessing as mp
+from collections import OrderedDict
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+from settings import BUFFER_SPILL_DIR, BUFFER_STATS_INTERVAL
+
+BUFFER_POLICIES = ['block', 'drop-oldest', 'coalesce', 'spill']
+
+class SpillFile(object):
+    """
+    FIFO of pickled records in a temporary file, the file is truncated
+    whenever it runs empty
+    """
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.count = 0
+        self.rpos = 0
+        self.wpos = 0
+        self.next_rpos = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        self.file.seek(self.wpos)
+        self.file.write(struct.pack('!I', len(data)))
+        self.file.write(data)
+        self.wpos = self.file.tell()
+        self.count += 1
+
+    def peek(self):
+        self.file.seek(self.rpos)
+        length = struct.unpack('!I', self.file.read(4))[0]
+        item = pickle.loads(self.file.read(length))
+        self.next_rpos = self.rpos + 4 + length
+        return item
+
+    def popleft(self):
+        self.rpos = self.next_rpos
+        self.count -= 1
+        if self.count == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.rpos = self.wpos = self.next_rpos = 0
+
+class BufferReader(object):
+    """
+    Consumer end of a buffer, provides get() like a queue as well as poll()
+    and recv() like the receiving end of a multiprocessing Pipe
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.item = None
+        self.has_item = False
+
+    def poll(self, timeout=0):
+        if not self.has_item:
+            try:
+                self.item = self.queue.get(timeout is None or timeout > 0, timeout or None)
+            except Empty:
+                return False
+            self.has_item = True
+        return True
+
+    def recv(self):
+        self.poll(None)
+        self.has_item = False
+        return self.item
+
+    def get(self, block=True, timeout=None):
+        if not self.has_item:
+            return self.queue.get(block, timeout)
+        self.has_item = False
+        return self.item
+
+class StageBuffer(object):
+    """
+    Producer end of a bounded buffer of `size` records, backed by a
+    multiprocessing Queue unless another queue is given. Overflowing records
+    of the coalesce and spill policies are held by the producer and handed
+    on in order by a feeder thread. The 'STOP' record is never dropped.
+    """
+    def __init__(self, name, size, policy='block', key=None, queue=None,
+                 spill_dir=BUFFER_SPILL_DIR):
+        if policy not in BUFFER_POLICIES:
+            raise ValueError('Invalid buffer policy: ' + policy)
+        if policy == 'coalesce' and key is None:
+            raise ValueError('Buffer policy coalesce requires a key.')
+        self.name = name
+        self.size = max(1, size)
+        self.policy = policy
+        self.key = key
+        self.spill_dir = spill_dir
+        self.queue = queue
+        if self.queue is None:
+            self.queue = mp.Queue(self.size)
+        self.overflow = None
+        self.cond = None
+        self.counters = {'put': 0, 'blocked': 0, 'dropped': 0,
+                         'coalesced': 0, 'spilled': 0}
+        self.hwm = 0
+        self.last_stats = time.time()
+        # number of records to put blocking after a kept record, once they
+        # are queued the kept record has left the queue and cannot be dropped
+        self.guard = 0
+
+    def reader(self):
+        return BufferReader(self.queue)
+
+    def depth(self):
+        """
+        Returns number of buffered records, or -1 if the platform does not
+        support queue sizes
+        """
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:
+            return -1
+        if self.overflow is not None:
+            depth += len(self.overflow)
+        return depth
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['depth'] = self.depth()
+        stats['hwm'] = self.hwm
+        return stats
+
+    def put(self, item, keep=False):
+        if item == 'STOP':
+            self._wait_overflow()
+            self.queue.put(item)
+            return
+        self.counters['put'] += 1
+        if keep:
+            # behind all overflowing records, to keep the order
+            self._wait_overflow()
+            self._put_block(item)
+            if self.policy == 'drop-oldest':
+                self.guard = self.size
+        elif self.guard > 0:
+            self.guard -= 1
+            self._put_block(item)
+        elif self.policy == 'drop-oldest':
+            self._put_drop_oldest(item)
+        elif self.policy == 'coalesce' or self.policy == 'spill':
+            self._put_overflow(item)
+        else:
+            self._put_block(item)
+        depth = self.depth()
+        if depth > self.hwm:
+            self.hwm = depth
+        if time.time() - self.last_stats > BUFFER_STATS_INTERVAL:
+            self.last_stats = time.time()
+            logging.info("buffer " + self.name + ": " + json.dumps(self.stats(), sort_keys=True))
+
+    def _put_block(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.counters['blocked'] += 1
+            self.queue.put(item)
+
+    def _put_drop_oldest(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.counters['dropped'] += 1
+                except Empty:
+                    pass
+
+    def _put_overflow(self, item):
+        if self.cond is None:
+            self._start_feeder()
+        with self.cond:
+            if len(self.overflow) == 0:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except Full:
+                    pass
+            if self.policy == 'spill':
+                self.overflow.append(item)
+                self.counters['spilled'] += 1
+            else:
+                key = self.key(item)
+                if key in self.overflow:
+                    self.counters['coalesced'] += 1
+                else:
+                    if len(self.overflow) >= self.size:
+                        self.counters['blocked'] += 1
+                    while len(self.overflow) >= self.size:
+                        self.cond.wait()
+                self.overflow[key] = item
+            self.cond.notify_all()
+
+    def _wait_overflow(self):
+        if self.cond is None:
+            return
+        with self.cond:
+            while len(self.overflow) > 0:
+                self.cond.wait()
+
+    def _start_feeder(self):
+        if self.policy == 'spill':
+            self.overflow = SpillFile(self.spill_dir)
+        else:
+            self.overflow = OrderedDict()
+        self.cond = threading.Condition()
+        feeder = threading.Thread(target=self._feed)
+        feeder.daemon = True
+        feeder.start()
+
+    def _feed(self):
+        """
+        Move overflowing records into the queue, a record is removed from
+        the overflow only once it is queued, to keep the order of records
+        """
+        while True:
+            with self.cond:
+                while len(self.overflow) == 0:
+                    self.cond.wait()
+                if self.policy == 'spill':
+                    key = None
+                    item = self.overflow.peek()
+                else:
+                    key, item = next(iter(self.overflow.items()))
+            self.queue.put(item)
+            with self.cond:
+                if self.policy == 'spill':
+                    self.overflow.popleft()
+                elif self.overflow.get(key) is item:
+                    del self.overflow[key]
+                self.cond.notify_all()
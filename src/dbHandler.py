@@ -1,15 +1,18 @@
 #!/usr/bin/python
 import argparse
 import gc
-import json
 import logging
 import sys
 
 import multiprocessing as mp
 
 # internal imports
-from mongodb import output_data, output_latest, output_stat
-from settings import DEFAULT_LOG_LEVEL, DEFAULT_MONGO_DATABASE, DOSTATS_INTERVAL
+from buffers import StageBuffer
+from mongodb import output_data, output_stat, output_stat_changes
+from settings import DEFAULT_LOG_LEVEL, DEFAULT_MONGO_DATABASE, DOSTATS_INTERVAL, \
+                     HISTORY_RETENTION, HISTORY_KEEP, HISTORY_TTL, WIRE_FORMAT, \
+                     BUFFER_SIZE, LATEST_PER_PEER, STATS_FEED, STATS_FEEDS, HISTORY_ARCHIVE
+from wire import WireReader, WIRE_FORMATS
 
 def main():
     parser = argparse.ArgumentParser(description='', epilog='')
@@ -22,6 +25,32 @@ def main():
     parser.add_argument('-m', '--mongodb',
                         help='MongoDB connection parameters.',
                         type=str, default=DEFAULT_MONGO_DATABASE['uri'])
+    parser.add_argument('-r', '--retention',
+                        help='History retention of validation results.',
+                        choices=['latest', 'last', 'ttl', 'all'],
+                        type=str, default=HISTORY_RETENTION)
+    parser.add_argument('-k', '--keep',
+                        help='Number of results kept per prefix, with retention last.',
+                        type=int, default=HISTORY_KEEP)
+    parser.add_argument('-t', '--ttl',
+                        help='Lifetime of results in seconds, with retention ttl.',
+                        type=int, default=HISTORY_TTL)
+    parser.add_argument('-A', '--archive',
+                        help='Record validity state transitions per prefix and origin.',
+                        action='store_true', default=HISTORY_ARCHIVE)
+    parser.add_argument('-p', '--per-peer',
+                        help='Keep latest results per BGP peer, not only per prefix and origin.',
+                        action='store_true', default=LATEST_PER_PEER)
+    parser.add_argument('-s', '--buffer-size',
+                        help='Number of buffered records, a full buffer stops reading input.',
+                        type=int, default=BUFFER_SIZE)
+    parser.add_argument('-S', '--stats-feed',
+                        help='Maintain stats in the writer (local), from a change stream '
+                        + '(changestream) or by periodic aggregation (poll).',
+                        choices=STATS_FEEDS, default=STATS_FEED)
+    parser.add_argument('--wire',
+                        help='Encoding of input records.',
+                        choices=WIRE_FORMATS, default=WIRE_FORMAT)
 
     args = vars(parser.parse_args())
 
@@ -31,7 +60,7 @@ def main():
     logging.basicConfig(level=numeric_level,
                         format='%(asctime)s : %(levelname)s : %(message)s')
 
-    pipe_recv, pipe_send = mp.Pipe(False)
+    data_buffer = StageBuffer('database input', args['buffer_size'])
     dbconnstr = None
     # BEGIN
     logging.info("START")
@@ -39,36 +68,31 @@ def main():
 
     # thread1: write data to database
     output_data_p = mp.Process(target=output_data,
-                               args=(dbconnstr, pipe_recv, args['dropdata']))
+                               args=(dbconnstr, data_buffer.reader(), args['dropdata'],
+                                     args['retention'], max(1, args['keep']), args['ttl'],
+                                     args['per_peer'], args['stats_feed'], args['archive']))
     output_data_p.start()
 
-    # thread2: filter latest validation results
-    output_latest_p = mp.Process(target=output_latest,
-                                 args=(dbconnstr,))
-    output_latest_p.start()
-
-    # thread3: generate stats from database
+    # thread2: generate stats from database, unless done by thread1
     stats_interval = DOSTATS_INTERVAL
     if stats_interval < 1:
         stats_interval = 60
-    output_stat_p = mp.Process(target=output_stat,
-                               args=(dbconnstr, stats_interval))
-    output_stat_p.start()
+    if args['stats_feed'] != 'local':
+        if args['stats_feed'] == 'changestream':
+            output_stat_p = mp.Process(target=output_stat_changes,
+                                       args=(dbconnstr, stats_interval))
+        else:
+            output_stat_p = mp.Process(target=output_stat,
+                                       args=(dbconnstr, stats_interval))
+        output_stat_p.start()
 
     # main loop, read data from STDIN to be stored in database
-    while True:
-        line = sys.stdin.readline().strip()
-        if line.strip() == 'STOP':
+    for data in WireReader(sys.stdin, args['wire']):
+        if data == 'STOP':
             break
         # end if
-        try:
-            data = json.loads(line, strict=False)
-        except ValueError:
-            logging.exception("Failed to parse JSON from input.")
-        else:
-            pipe_send.send(data)
-        # end try
-    # end while
+        data_buffer.put(data)
+    # end for
 
 if __name__ == "__main__":
     main()
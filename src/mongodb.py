@@ -1,62 +1,47 @@
+import calendar
 import gc
 import logging
 import time
 
 from datetime import datetime
-from bson.son import SON
-from bson.code import Code
-from pymongo import MongoClient
-from settings import BULK_TIMEOUT, BULK_MAX_OPS
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from settings import BULK_TIMEOUT, BULK_MAX_OPS, HISTORY_RETENTION, HISTORY_KEEP, HISTORY_TTL, \
+                     LATEST_PER_PEER, ORIGIN_INVALID_MAX, STATS_CHECKPOINT_INTERVAL, STATS_FEED, \
+                     STATS_RESOLUTIONS, STATS_RETENTION, HISTORY_ARCHIVE
+from vrptable import parse_prefix, VALIDITY_STATES, ARCHIVE_STATES
 
 logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s : %(levelname)s : %(message)s')
 
-def output_latest(dbconnstr):
-    """Generate and store latest validation results in database"""
-    logging.info("CALL output_latest, with mongodb: " +dbconnstr)
-    # open db connection
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
-    f_map = Code(
-        "function() {"
-        "  var key = this.prefix;"
-        "  var value = {timestamp: this.timestamp, type: this.type, validated_route: null};"
-        "  if (this.type == 'announcement') {"
-        "    value['validated_route'] = this.validated_route;"
-        "  }"
-        "  emit (key, value);"
-        "}"
-    )
-    f_reduce = Code(
-        "function (key, values) {"
-        "  var robj = { timestamp: 0, type: null, validated_route: null};"
-        "  values.forEach(function(value) {"
-        "    if ((value != null) && (value.timestamp > robj.timestamp)) {"
-        "      robj.timestamp = value.timestamp;"
-        "      robj.type = value.type;"
-        "      if (value.type == 'announcement') {"
-        "        robj.validated_route = value.validated_route;"
-        "      }"
-        "      else {"
-        "        robj.validated_route = null;"
-        "      }"
-        "    }"
-        "  } );"
-        "  return robj;"
-        "}"
-    )
-    last_validity_count = 0
-    while True:
-        try:
-            if database.validity.count() != last_validity_count:
-                database.validity.map_reduce(
-                    f_map, f_reduce,
-                    out=SON([("replace", "validity_latest")])
-                )
-                last_validity_count = database.validity.count()
-        except Exception as errmsg:
-            logging.exception("MapReduce failed with: " + str(errmsg))
-        # end try
-        time.sleep(BULK_TIMEOUT)
+def _new_rollup():
+    rollup = dict()
+    for afi, bits in ((4, 32), (6, 128)):
+        stats = dict()
+        for state in VALIDITY_STATES:
+            stats['num_' + state] = 0
+            stats['len_' + state] = [0] * (bits + 1)
+        rollup['ipv' + str(afi)] = stats
+    return rollup
+
+def _update_series(database, stats):
+    """Add a sample of the validation stats to the time series in
+    validity_stats, i.e., to its bucket per resolution. A bucket holds the
+    sum and count of its samples, and the values of its latest sample.
+    Buckets older than the retention of their resolution are removed."""
+    bulk = database.validity_stats.initialize_unordered_bulk_op()
+    for res, seconds in STATS_RESOLUTIONS:
+        bucket = stats['ts'] - stats['ts'] % seconds
+        values = {'res': res, 'ts': bucket, 'last_ts': stats['ts']}
+        incs = {'count': 1}
+        for state in VALIDITY_STATES:
+            values['num_' + state] = stats['num_' + state]
+            incs['sum_' + state] = stats['num_' + state]
+        bulk.find({'_id': res + ' ' + str(bucket)}).upsert().update_one(
+            {'$set': values, '$inc': incs})
+    for res, seconds in STATS_RESOLUTIONS:
+        if STATS_RETENTION.get(res, 0) > 0:
+            bulk.find({'res': res, 'ts': {'$lt': stats['ts'] - STATS_RETENTION[res]}}).remove()
+    bulk.execute()
 
 def output_stat(dbconnstr, interval):
     """Generate and store validation statistics in database"""
@@ -90,7 +75,7 @@ def output_stat(dbconnstr, interval):
         # end try
         if stats['ts'] != 'now':
             try:
-                database.validity_stats.replace_one({'ts': stats['ts']}, stats, True)
+                _update_series(database, stats)
             except Exception as errmsg:
                 logging.exception("INSERT into stats failed with: " + str(errmsg))
             # end try
@@ -98,8 +83,586 @@ def output_stat(dbconnstr, interval):
         time.sleep(interval)
     # end while
 
-def output_data(dbconnstr, pipe, dropdata):
-    """Store validation results into database"""
+def output_stat_changes(dbconnstr, interval):
+    """Maintain validation statistics from the change stream of
+    validity_latest, falls back to polling if change streams are not
+    supported, i.e., MongoDB is not run as replica set, with the given
+    interval"""
+    logging.info("CALL output_stat_changes, with mongodb: " +dbconnstr)
+    client = MongoClient(dbconnstr)
+    database = client.get_default_database()
+    # the rollup is maintained by the database writer
+    engine = StatsEngine(rollup=False)
+    try:
+        # open stream before loading, such that no change is missed
+        with database.validity_latest.watch(full_document='updateLookup',
+                                            max_await_time_ms=1000) as stream:
+            engine.load(database)
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    engine.apply_change(change)
+                if engine.due():
+                    engine.checkpoint(database)
+    except Exception as errmsg:
+        logging.exception("change stream on validity_latest failed with: " + str(errmsg))
+    # end try
+    client.close()
+    output_stat(dbconnstr, interval)
+
+def _get_range(prefix):
+    """Address range of a prefix, bounds as fixed-width hex strings such that
+    string order equals numeric order"""
+    version, value, length = parse_prefix(prefix)
+    bits = 32 if version == 4 else 128
+    width = bits // 4
+    last = value | ((1 << (bits - length)) - 1)
+    return {'afi': version, 'len': length,
+            'lo': '%0*x' % (width, value), 'hi': '%0*x' % (width, last)}
+
+def _get_latest_id(prefix, origin, peer=None):
+    """Key of a route in validity_latest, i.e., prefix and origin AS, and
+    optionally the BGP peer it was received from"""
+    if peer is None:
+        return prefix + ' ' + origin
+    return prefix + ' ' + origin + ' ' + peer
+
+def _execute_latest(bulk, action="update latest"):
+    try:
+        bulk.execute()
+    except BulkWriteError as bwe:
+        # duplicate keys of routes already written with newer results
+        errors = [e for e in bwe.details['writeErrors'] if e['code'] != 11000]
+        if len(errors) > 0:
+            logging.error(action + ", failed with: " + str(errors[0]['errmsg']))
+    except Exception as errmsg:
+        logging.exception(action + ", failed with: " + str(errmsg))
+    # end try
+
+def _update_latest(database, latest, per_peer=LATEST_PER_PEER):
+    """Upsert latest validation result per route into validity_latest. A BGP
+    peer has a single route per prefix, i.e., its announcement replaces its
+    route of any other origin and its withdraw removes its route. Unless per
+    peer, a route lists the peers announcing it, and is marked as withdrawn
+    once no peer is left. Routes without that list, as written by previous
+    versions, are released by any peer."""
+    if len(latest) == 0:
+        return
+    bulk = database.validity_latest.initialize_unordered_bulk_op()
+    for prefix, routes in latest.items():
+        try:
+            prefix_range = _get_range(prefix)
+        except Exception:
+            logging.warning("cannot parse prefix " + prefix)
+            prefix_range = None
+        for peer, data in routes.items():
+            origin = None
+            if data['type'] == 'announcement':
+                origin = data['validated_route']['route']['origin_asn']
+            # release the previous route of the peer
+            query = {'prefix': prefix}
+            if origin is not None:
+                query['origin'] = {'$ne': origin}
+            if per_peer:
+                query['peer'] = peer
+                query['value.timestamp'] = {'$lte': data['timestamp']}
+                bulk.find(query).update({'$set': {'value': {'timestamp': data['timestamp'],
+                                                            'type': 'withdraw',
+                                                            'validated_route': None}}})
+            else:
+                query['peers'] = peer
+                bulk.find(dict(query)).update({'$pull': {'peers': peer}})
+                query['peers'] = {'$exists': False}
+                query['value.timestamp'] = {'$lte': data['timestamp']}
+                bulk.find(query).update({'$set': {'peers': list()}})
+            if origin is None:
+                continue
+            value = {'timestamp': data['timestamp'], 'type': data['type'],
+                     'validated_route': data['validated_route']}
+            doc = {'prefix': prefix, 'origin': origin, 'value': value}
+            if prefix_range is not None:
+                doc['range'] = prefix_range
+            # only replace results older than this one, otherwise the upsert
+            # fails with a duplicate key error which is ignored
+            if per_peer:
+                doc['peer'] = peer
+                bulk.find({'_id': _get_latest_id(prefix, origin, peer),
+                           'value.timestamp': {'$lte': data['timestamp']}}) \
+                    .upsert().replace_one(doc)
+            else:
+                bulk.find({'_id': _get_latest_id(prefix, origin),
+                           'value.timestamp': {'$lte': data['timestamp']}}) \
+                    .upsert().update_one({'$set': doc, '$addToSet': {'peers': peer}})
+                bulk.find({'_id': _get_latest_id(prefix, origin), 'value.type': 'announcement'}) \
+                    .update_one({'$addToSet': {'peers': peer}})
+    _execute_latest(bulk)
+    if per_peer:
+        return
+    # routes released by their last peer are withdrawn
+    bulk = database.validity_latest.initialize_unordered_bulk_op()
+    for prefix, routes in latest.items():
+        timestamp = max(data['timestamp'] for data in routes.values())
+        bulk.find({'prefix': prefix, 'peers': {'$size': 0}, 'value.type': 'announcement'}) \
+            .update({'$set': {'value.type': 'withdraw', 'value.validated_route': None},
+                     '$max': {'value.timestamp': timestamp}})
+    _execute_latest(bulk)
+
+def _update_origins(database, origins):
+    """Recompute the summaries of the given origin ASNs in origin_summary:
+    number of routes per state and (up to ORIGIN_INVALID_MAX) invalid
+    prefixes, using the origin index of validity_latest. Afterwards the
+    summaries are maintained by an OriginWriter."""
+    if len(origins) == 0:
+        return
+    summaries = dict()
+    for origin in origins:
+        summaries[origin] = {'invalid': list()}
+        for state in VALIDITY_STATES:
+            summaries[origin]['num_' + state] = 0
+    try:
+        pipeline = [
+            {"$match": {'origin': {'$in': list(origins)}, 'value.type': 'announcement'}},
+            {"$group": {"_id": {'origin': '$origin',
+                                'state': '$value.validated_route.validity.state'},
+                        "count": {"$sum": 1}}}
+        ]
+        for res in database.validity_latest.aggregate(pipeline, allowDiskUse=True):
+            if res['_id'].get('state') in VALIDITY_STATES:
+                summaries[res['_id']['origin']]['num_' + res['_id']['state']] = res['count']
+        pipeline = [
+            {"$match": {'origin': {'$in': list(origins)},
+                        'value.validated_route.validity.state': {'$in': ['InvalidAS',
+                                                                         'InvalidLength']}}},
+            {"$group": {"_id": '$origin',
+                        "invalid": {"$push": {'prefix': '$prefix',
+                                              'state': '$value.validated_route.validity.state'}}}},
+            {"$project": {'invalid': {"$slice": ['$invalid', ORIGIN_INVALID_MAX]}}}
+        ]
+        for res in database.validity_latest.aggregate(pipeline, allowDiskUse=True):
+            summaries[res['_id']]['invalid'] = res['invalid']
+        bulk = database.origin_summary.initialize_unordered_bulk_op()
+        for origin, summary in summaries.items():
+            if sum(summary['num_' + state] for state in VALIDITY_STATES) == 0:
+                bulk.find({'_id': origin}).remove_one()
+            else:
+                bulk.find({'_id': origin}).upsert().replace_one(summary)
+        bulk.execute()
+    except Exception as errmsg:
+        logging.exception("update origin summaries, failed with: " + str(errmsg))
+    # end try
+
+def _init_origins(database, chunk=1000):
+    """Create summaries of all origins, if origin_summary is empty"""
+    try:
+        if database.origin_summary.find_one() is not None:
+            return
+        origins = database.validity_latest.distinct('origin')
+    except Exception as errmsg:
+        logging.exception("init origin summaries, failed with: " + str(errmsg))
+        return
+    # end try
+    for i in range(0, len(origins), chunk):
+        _update_origins(database, origins[i:i+chunk])
+
+def _get_month(timestamp):
+    """Timestamp of the first second of the month (UTC)"""
+    date = datetime.utcfromtimestamp(timestamp)
+    return calendar.timegm(datetime(date.year, date.month, 1).timetuple())
+
+class ArchiveWriter(object):
+    """Record transitions of the validity state of routes, per prefix and
+    origin AS, in validity_archive. Transitions are stored in one document
+    per route and month, each encoded as a single integer: seconds since
+    the start of the month shifted left by 3 bits, plus the index of the
+    state in ARCHIVE_STATES."""
+    def __init__(self, database, max_ops=BULK_MAX_OPS):
+        self.database = database
+        self.max_ops = max_ops
+        # document key -> encoded transitions
+        self.events = dict()
+        self.events_len = 0
+        try:
+            database.validity_archive.create_index([('prefix', ASCENDING), ('base', ASCENDING)])
+        except Exception as errmsg:
+            logging.exception("create archive index, failed with: " + str(errmsg))
+        # end try
+
+    def add(self, prefix, origin, state, timestamp):
+        """Add transition of a route to state, None if withdrawn, see
+        _get_route_state"""
+        timestamp = int(timestamp)
+        base = _get_month(timestamp)
+        code = ARCHIVE_STATES.index(state if state is not None else 'withdraw')
+        key = (prefix, origin, base)
+        self.events.setdefault(key, list()).append(((timestamp - base) << 3) | code)
+        self.events_len += 1
+        if self.events_len >= self.max_ops:
+            self.flush()
+
+    def flush(self):
+        if self.events_len == 0:
+            return
+        bulk = self.database.validity_archive.initialize_unordered_bulk_op()
+        for (prefix, origin, base), events in self.events.items():
+            bulk.find({'_id': prefix + ' ' + origin + ' ' + str(base)}).upsert().update_one(
+                {'$setOnInsert': {'prefix': prefix, 'origin': origin, 'base': base},
+                 '$push': {'e': {'$each': events}}})
+        try:
+            bulk.execute()
+        except Exception as errmsg:
+            logging.exception("archive bulk operation, failed with: " + str(errmsg))
+        # end try
+        self.events = dict()
+        self.events_len = 0
+
+class OriginWriter(object):
+    """Maintain the summaries in origin_summary incrementally, from the
+    changes of the state of routes: counters are updated by $inc, prefixes
+    becoming invalid are added to the list of invalid prefixes (up to
+    ORIGIN_INVALID_MAX) and removed again once they are no longer."""
+    INVALID_STATES = ['InvalidAS', 'InvalidLength']
+
+    def __init__(self, database, max_invalid=ORIGIN_INVALID_MAX):
+        self.database = database
+        self.max_invalid = max_invalid
+        # origin -> {'num_<state>': change}
+        self.counts = dict()
+        # (origin, prefix, old state, new state) in order of changes
+        self.invalid = list()
+
+    def count(self, origin, old_state, new_state):
+        """Change of the state of a route, None if not counted"""
+        counts = self.counts.setdefault(origin, dict())
+        if old_state is not None:
+            counts['num_' + old_state] = counts.get('num_' + old_state, 0) - 1
+        if new_state is not None:
+            counts['num_' + new_state] = counts.get('num_' + new_state, 0) + 1
+
+    def change(self, prefix, origin, old_state, new_state):
+        """Change of the state of a prefix and origin"""
+        if (old_state in self.INVALID_STATES) or (new_state in self.INVALID_STATES):
+            self.invalid.append((origin, prefix, old_state, new_state))
+
+    def flush(self):
+        if len(self.counts) == 0 and len(self.invalid) == 0:
+            return
+        # ordered, removing a prefix from the list precedes adding it again
+        bulk = self.database.origin_summary.initialize_ordered_bulk_op()
+        for origin, counts in self.counts.items():
+            incs = dict((key, value) for key, value in counts.items() if value != 0)
+            if len(incs) > 0:
+                # new summaries hold counters of all states
+                defaults = dict(('num_' + state, 0) for state in VALIDITY_STATES
+                                if 'num_' + state not in incs)
+                defaults['invalid'] = list()
+                bulk.find({'_id': origin}).upsert().update_one(
+                    {'$inc': incs, '$setOnInsert': defaults})
+        for origin, prefix, old_state, new_state in self.invalid:
+            if old_state in self.INVALID_STATES:
+                bulk.find({'_id': origin}).update_one({'$pull': {'invalid': {'prefix': prefix}}})
+            if new_state in self.INVALID_STATES:
+                bulk.find({'_id': origin}).update_one(
+                    {'$push': {'invalid': {'$each': [{'prefix': prefix, 'state': new_state}],
+                                           '$slice': self.max_invalid}}})
+        # remove summaries of origins without routes
+        empty = dict(('num_' + state, {'$not': {'$gt': 0}}) for state in VALIDITY_STATES)
+        for origin in self.counts:
+            query = dict(empty)
+            query['_id'] = origin
+            bulk.find(query).remove_one()
+        try:
+            bulk.execute()
+        except Exception as errmsg:
+            logging.exception("origin summary bulk operation, failed with: " + str(errmsg))
+        # end try
+        self.counts = dict()
+        self.invalid = list()
+
+def _get_state(state):
+    """State counted by the StatsEngine, None for withdrawn routes and routes
+    in other states, e.g., Error if the validation failed"""
+    if state in VALIDITY_STATES:
+        return state
+    return None
+
+def _get_best(routes):
+    """State of a prefix, i.e., best counted state of its announced routes"""
+    best = None
+    for state, _ in routes.values():
+        if state in VALIDITY_STATES and (best is None or
+                                         VALIDITY_STATES.index(state) <
+                                         VALIDITY_STATES.index(best)):
+            best = state
+    return best
+
+def _get_route_state(routes):
+    """State of a prefix and origin, i.e., of its routes, in validity_archive:
+    the best counted state, Error if announced but in none of the counted
+    states, or None if withdrawn"""
+    best = _get_best(routes)
+    if best is None and any(state is not None for state, _ in routes.values()):
+        return 'Error'
+    return best
+
+class StatsEngine(object):
+    """Running counters of validity_latest, routes per state and prefix
+    length histograms per address family, updated from the results written
+    by a ValidityWriter (local feed) or from a change stream. Periodically,
+    unless interval is 0, the counters are stored as checkpoint in the time
+    series of validity_stats, if series is set, and in validity_rollup, if
+    rollup is set. Changes of the state of routes are passed to the optional
+    OriginWriter, and changes of the state of a prefix and origin to the
+    optional ArchiveWriter as well."""
+    def __init__(self, interval=STATS_CHECKPOINT_INTERVAL, archive=None, summaries=None,
+                 series=True, rollup=True):
+        self.interval = interval
+        self.archive = archive
+        self.summaries = summaries
+        self.series = series
+        self.store_rollup = rollup
+        # prefix -> {(origin, peer): (state, timestamp)}, state of withdrawn
+        # routes is None, routes in other states, e.g., Error, are not counted
+        self.prefixes = dict()
+        self.rollup = _new_rollup()
+        self.latest_ts = 0
+        self.last_checkpoint = time.time()
+
+    @staticmethod
+    def _find(database, query):
+        return database.validity_latest.find(
+            query, {'_id': 0, 'prefix': 1, 'origin': 1, 'peer': 1, 'value.type': 1,
+                    'value.timestamp': 1, 'value.validated_route.validity.state': 1})
+
+    def load(self, database):
+        """Initialize counters from validity_latest"""
+        self.prefixes = dict()
+        self.rollup = _new_rollup()
+        self.latest_ts = 0
+        # loaded routes are no transitions
+        archive = self.archive
+        summaries = self.summaries
+        self.archive = None
+        self.summaries = None
+        for res in self._find(database, {}):
+            if 'prefix' in res:
+                self._replace(res['prefix'], {(res.get('origin'), res.get('peer')):
+                                              self._get_value(res)})
+        self.archive = archive
+        self.summaries = summaries
+        logging.info("stats engine, loaded " + str(len(self.prefixes)) + " prefixes")
+
+    def reload(self, database, prefixes, chunk=BULK_MAX_OPS):
+        """Local feed, replace the routes of the given prefixes by their
+        results in validity_latest, as written by a ValidityWriter bulk. This
+        includes routes released by _update_latest."""
+        prefixes = list(prefixes)
+        for i in range(0, len(prefixes), chunk):
+            results = dict((prefix, dict()) for prefix in prefixes[i:i+chunk])
+            for res in self._find(database, {'prefix': {'$in': prefixes[i:i+chunk]}}):
+                results[res['prefix']][(res.get('origin'), res.get('peer'))] = \
+                    self._get_value(res)
+            for prefix, routes in results.items():
+                known = self.prefixes.get(prefix, dict())
+                changes = dict((key, None) for key in known if key not in routes)
+                changes.update((key, value) for key, value in routes.items()
+                               if known.get(key) != value)
+                if len(changes) > 0:
+                    self._replace(prefix, changes)
+        self.flush()
+
+    @staticmethod
+    def _get_value(doc):
+        value = doc['value']
+        if value['type'] != 'announcement':
+            return (None, value['timestamp'])
+        return (value['validated_route']['validity']['state'], value['timestamp'])
+
+    def _replace(self, prefix, changes):
+        """Replace routes of a prefix, a change to None removes the route"""
+        try:
+            version, _, length = parse_prefix(prefix)
+        except Exception:
+            logging.warning("stats engine, cannot parse prefix " + prefix)
+            return
+        stats = self.rollup['ipv' + str(version)]
+        routes = self.prefixes.setdefault(prefix, dict())
+        best = _get_best(routes)
+        origin_states = dict()
+        if (self.archive is not None) or (self.summaries is not None):
+            origin_states = dict((key[0],
+                                  _get_route_state(self._get_origin_routes(routes, key[0])))
+                                 for key in changes)
+        timestamp = self.latest_ts
+        for key, value in changes.items():
+            old = routes.pop(key, None)
+            old_state = _get_state(old[0]) if old is not None else None
+            new_state = _get_state(value[0]) if value is not None else None
+            if old_state is not None:
+                stats['num_' + old_state] -= 1
+            if self.summaries is not None:
+                self.summaries.count(key[0], old_state, new_state)
+            if value is None:
+                continue
+            if new_state is not None:
+                stats['num_' + new_state] += 1
+            routes[key] = value
+            timestamp = int(value[1])
+            self.latest_ts = max(self.latest_ts, timestamp)
+        for origin, state in origin_states.items():
+            new_state = _get_route_state(self._get_origin_routes(routes, origin))
+            if new_state == state:
+                continue
+            if self.summaries is not None:
+                self.summaries.change(prefix, origin, state, new_state)
+            if self.archive is not None:
+                self.archive.add(prefix, origin, new_state, timestamp)
+        new_best = _get_best(routes)
+        if best != new_best:
+            if best is not None:
+                stats['len_' + best][length] -= 1
+            if new_best is not None:
+                stats['len_' + new_best][length] += 1
+        if len(routes) == 0:
+            del self.prefixes[prefix]
+
+    @staticmethod
+    def _get_origin_routes(routes, origin):
+        return dict((key, value) for key, value in routes.items() if key[0] == origin)
+
+    def flush(self):
+        """Write pending changes of origin summaries and archive"""
+        if self.summaries is not None:
+            self.summaries.flush()
+        if self.archive is not None:
+            self.archive.flush()
+
+    def apply_change(self, change):
+        """Change stream feed, apply a change event of validity_latest"""
+        operation = change.get('operationType')
+        if operation in ('insert', 'replace', 'update'):
+            doc = change.get('fullDocument')
+            if doc is not None and 'prefix' in doc:
+                self._replace(doc['prefix'], {(doc.get('origin'), doc.get('peer')):
+                                              self._get_value(doc)})
+        elif operation == 'delete':
+            # key of validity_latest, i.e., prefix, origin and optionally peer
+            fields = change['documentKey']['_id'].split(' ')
+            if len(fields) > 1:
+                peer = fields[2] if len(fields) > 2 else None
+                self._replace(fields[0], {(fields[1], peer): None})
+        elif operation in ('drop', 'dropDatabase', 'invalidate'):
+            self.prefixes = dict()
+            self.rollup = _new_rollup()
+
+    def get_stats(self):
+        stats = {'ts': self.latest_ts}
+        for state in VALIDITY_STATES:
+            stats['num_' + state] = sum(self.rollup[afi]['num_' + state]
+                                        for afi in ('ipv4', 'ipv6'))
+        return stats
+
+    def due(self):
+        return (self.interval > 0) and (time.time() - self.last_checkpoint > self.interval)
+
+    def checkpoint(self, database):
+        """Store counters, skipped as long as no result is known"""
+        self.last_checkpoint = time.time()
+        self.flush()
+        if self.latest_ts == 0:
+            return
+        try:
+            if self.series:
+                _update_series(database, self.get_stats())
+            if self.store_rollup:
+                rollup = {'ipv4': self.rollup['ipv4'], 'ipv6': self.rollup['ipv6'],
+                          'ts': self.latest_ts}
+                database.validity_rollup.replace_one({'_id': 'ipversion'}, rollup, True)
+        except Exception as errmsg:
+            logging.exception("stats checkpoint, failed with: " + str(errmsg))
+        # end try
+
+class ValidityWriter(object):
+    """Buffer validation results and write them in bulk into validity and
+    validity_latest, followed by history maintenance"""
+    def __init__(self, database, retention=HISTORY_RETENTION, keep=HISTORY_KEEP,
+                 ttl=HISTORY_TTL, max_ops=BULK_MAX_OPS, timeout=BULK_TIMEOUT,
+                 per_peer=LATEST_PER_PEER, engine=None):
+        self.database = database
+        self.retention = retention
+        self.keep = keep
+        self.max_ops = max_ops
+        self.timeout = timeout
+        self.per_peer = per_peer
+        _migrate_latest(database)
+        _migrate_stats(database)
+        _ensure_indexes(database, retention, ttl)
+        _init_origins(database)
+        # optional StatsEngine, fed with the latest results of each bulk, it
+        # maintains the origin summaries and archive, if given
+        self.engine = engine
+        if self.engine is not None:
+            self.engine.load(database)
+        self.bulk = database.validity.initialize_unordered_bulk_op()
+        self.bulk_len = 0
+        # prefix -> {peer: latest announcement or withdraw} within current bulk
+        self.latest = dict()
+        self.begin = datetime.now()
+
+    def add(self, data):
+        if (data['type'] != 'announcement') and (data['type'] != 'withdraw'):
+            logging.warning("Type not supported, must be either announcement or withdraw!")
+            return
+        logging.debug("process announcement or withdraw of prefix: " + data['prefix'])
+        if self.retention == 'ttl':
+            data['recorded'] = datetime.utcnow()
+        try:
+            self.bulk.insert(data)
+        except Exception as errmsg:
+            logging.exception("bulk insert, failed with: " + str(errmsg))
+        else:
+            self.bulk_len += 1
+            self._add_latest(data)
+
+    def _add_latest(self, data):
+        # the latest result of a peer supersedes its earlier ones, whatever
+        # their origin, as it replaces the route of the peer
+        routes = self.latest.setdefault(data['prefix'], dict())
+        peer = data.get('source')
+        if (peer not in routes) or (data['timestamp'] >= routes[peer]['timestamp']):
+            routes[peer] = data
+
+    def due(self):
+        timeout = datetime.now() - self.begin
+        return (self.bulk_len > self.max_ops) or \
+            (self.bulk_len > 0 and timeout.total_seconds() > self.timeout)
+
+    def flush(self):
+        logging.info("do mongo bulk operation ...")
+        if self.bulk_len > 0:
+            try:
+                self.bulk.execute({'w': 0})
+            except Exception as errmsg:
+                logging.exception("bulk operation, failed with: " + str(errmsg))
+            # end try bulk
+            _update_latest(self.database, self.latest, self.per_peer)
+            if self.engine is not None:
+                self.engine.reload(self.database, self.latest.keys())
+            newest = dict((prefix, max(routes.values(), key=lambda route: route['timestamp']))
+                          for prefix, routes in self.latest.items())
+            cleanup_data(self.database, newest, self.retention, self.keep)
+        if self.engine is not None and self.engine.due():
+            self.engine.checkpoint(self.database)
+        self.bulk = self.database.validity.initialize_unordered_bulk_op()
+        self.bulk_len = 0
+        self.latest = dict()
+        self.begin = datetime.now()
+
+def output_data(dbconnstr, pipe, dropdata, retention=HISTORY_RETENTION,
+                keep=HISTORY_KEEP, ttl=HISTORY_TTL, per_peer=LATEST_PER_PEER,
+                stats_feed=STATS_FEED, archive=HISTORY_ARCHIVE):
+    """Store validation results into database, and maintain the rollups,
+    the origin summaries and optionally the archive. With stats feed 'local'
+    the time series of validation statistics is maintained as well."""
     logging.debug("CALL output_data mongodb, with " + dbconnstr)
     client = MongoClient(dbconnstr)
     database = client.get_default_database()
@@ -107,72 +670,130 @@ def output_data(dbconnstr, pipe, dropdata):
         database.validity.drop()
         database.validity_stats.drop()
         database.validity_latest.drop()
+        database.validity_rollup.drop()
+        database.origin_summary.drop()
+        database.validity_archive.drop()
     # end dropdata
-    bulk = database.validity.initialize_unordered_bulk_op()
-    bulk_len = 0
-    begin = datetime.now()
+    engine = StatsEngine(archive=ArchiveWriter(database) if archive else None,
+                         summaries=OriginWriter(database), series=(stats_feed == 'local'))
+    writer = ValidityWriter(database, retention, keep, ttl, per_peer=per_peer, engine=engine)
     while True:
         data = pipe.recv()
         if data == 'DONE':
             break
-        if (data['type'] == 'announcement') or (data['type'] == 'withdraw'):
-            logging.debug("process announcement or withdraw of prefix: " + data['prefix'])
+        writer.add(data)
+        # exec bulk validity
+        if writer.due():
+            writer.flush()
+            gc.collect()
+
+def _ensure_indexes(database, retention, ttl):
+    """Create indexes required by the writer and history maintenance"""
+    try:
+        database.validity.create_index([('prefix', ASCENDING), ('timestamp', DESCENDING)])
+        database.validity_stats.create_index([('res', ASCENDING), ('ts', ASCENDING)])
+        database.validity_latest.create_index('prefix')
+        database.validity_latest.create_index([('origin', ASCENDING), ('prefix', ASCENDING)])
+        database.validity_latest.create_index([('range.afi', ASCENDING), ('range.lo', ASCENDING)])
+        database.validity_latest.create_index([('value.validated_route.validity.state', ASCENDING),
+                                               ('prefix', ASCENDING)])
+        database.validity_latest.create_index([('value.validated_route.validity.state', ASCENDING),
+                                               ('value.validated_route.route.origin_asn', ASCENDING)])
+        if retention == 'ttl':
+            database.validity.create_index('recorded', expireAfterSeconds=ttl)
+    except Exception as errmsg:
+        logging.exception("create indexes, failed with: " + str(errmsg))
+    # end try
+
+def _migrate_latest(database, chunk=BULK_MAX_OPS):
+    """Convert documents of validity_latest keyed by prefix only, as written
+    by previous versions, into per route documents, withdrawn ones are
+    removed"""
+    try:
+        count = 0
+        bulk = None
+        for doc in database.validity_latest.find({'prefix': {'$exists': False}}):
+            if bulk is None:
+                bulk = database.validity_latest.initialize_unordered_bulk_op()
+            bulk.find({'_id': doc['_id']}).remove_one()
+            count += 1
+            value = doc.get('value') or dict()
             try:
-                bulk.insert(data)
-            except Exception as errmsg:
-                logging.exception("bulk insert, failed with: " + str(errmsg))
-            else:
-                bulk_len += 1
-        else:
-            logging.warning("Type not supported, must be either announcement or withdraw!")
-            continue
+                origin = value['validated_route']['route']['origin_asn']
+            except (KeyError, TypeError):
+                origin = None
+            if value.get('type') == 'announcement' and origin is not None:
+                prefix = doc['_id']
+                new_doc = {'prefix': prefix, 'origin': origin, 'value': value}
+                try:
+                    new_doc['range'] = _get_range(prefix)
+                except Exception:
+                    logging.warning("cannot parse prefix " + prefix)
+                bulk.find({'_id': _get_latest_id(prefix, origin),
+                           'value.timestamp': {'$lte': value['timestamp']}}) \
+                    .upsert().replace_one(new_doc)
+            if count % chunk == 0:
+                _execute_latest(bulk, "migrate validity_latest")
+                bulk = None
+        if bulk is not None:
+            _execute_latest(bulk, "migrate validity_latest")
+        if count > 0:
+            logging.warning("converted " + str(count) + " per prefix results of "
+                            "validity_latest into per route results")
+    except Exception as errmsg:
+        logging.exception("migrate validity_latest, failed with: " + str(errmsg))
+    # end try
 
-        now = datetime.now()
-        timeout = now - begin
-        # exec bulk validity
-        if (bulk_len > BULK_MAX_OPS) or (timeout.total_seconds() > BULK_TIMEOUT):
-            logging.info("do mongo bulk operation ...")
-            # end try create file
+def _migrate_stats(database):
+    """Move samples of validity_stats, one document per timestamp as written
+    by previous versions, into the buckets of the time series"""
+    try:
+        count = 0
+        legacy = database.validity_stats.find({'res': {'$exists': False}})
+        for stats in legacy.sort('ts', ASCENDING):
             try:
-                bulk.execute({'w': 0})
-            except Exception as errmsg:
-                logging.exception("bulk operation, failed with: " + str(errmsg))
-            # end try bulk
-            bulk = database.validity.initialize_unordered_bulk_op()
-            bulk_len = 0
-            cleanup_data(dbconnstr)
-            gc.collect()
-            begin = datetime.now()
+                stats['ts'] = int(stats['ts'])
+            except (KeyError, TypeError, ValueError):
+                pass
+            else:
+                for state in VALIDITY_STATES:
+                    stats.setdefault('num_' + state, 0)
+                _update_series(database, stats)
+            database.validity_stats.delete_one({'_id': stats['_id']})
+            count += 1
+        if count > 0:
+            logging.warning("moved " + str(count) + " samples of validity_stats into buckets")
+    except Exception as errmsg:
+        logging.exception("migrate validity_stats, failed with: " + str(errmsg))
+    # end try
 
-def cleanup_data(dbconnstr):
-    """Cleanup data: remove old validation results from database"""
-    logging.debug("CALL cleanup_data mongodb, with " +dbconnstr)
-    client = MongoClient(dbconnstr)
-    database = client.get_default_database()
-    counter = 0
+def cleanup_data(database, latest, retention, keep):
+    """Cleanup data: remove superseded validation results of given prefixes"""
+    logging.debug("CALL cleanup_data mongodb, retention " + retention)
+    if (len(latest) == 0) or (retention not in ['latest', 'last']):
+        return
     try:
         bulk_remove = database.validity.initialize_unordered_bulk_op()
-        pipeline = [
-            {"$group": {
-                "_id": '$prefix',
-                "plist": {"$push" : {"pid": "$_id", "timestamp": "$timestamp"}},
-                "maxts": {"$max" : '$timestamp'}}
-            },
-            {"$unwind": "$plist"},
-            {"$project": {
-                "mark": {"$cond": [{"$lt": ["$plist.timestamp", "$maxts"]}, "true", "false"]},
-                "_id": '$plist.pid',
-                'maxts': '$maxts',
-                'timestamp': '$plist.timestamp'}
-            },
-            {"$match": {'mark': "true"}}
-        ]
-        results = database.validity.aggregate(pipeline, allowDiskUse=True)
-        for res in results:
-            counter += 1
-            bulk_remove.find({"_id": res['_id']}).remove_one()
-        if counter > 0:
-            bulk_remove.execute()
+        if retention == 'latest':
+            for prefix, data in latest.items():
+                bulk_remove.find({'prefix': prefix,
+                                  'timestamp': {'$lt': data['timestamp']}}).remove()
+        else:
+            # find timestamp of the keep-th newest result per prefix
+            pipeline = [
+                {"$match": {'prefix': {'$in': list(latest.keys())}}},
+                {"$sort": {'prefix': 1, 'timestamp': -1}},
+                {"$group": {"_id": '$prefix', "timestamps": {"$push": '$timestamp'}}},
+                {"$project": {"cutoff": {"$arrayElemAt": ['$timestamps', keep - 1]}}},
+                {"$match": {'cutoff': {"$exists": True}}}
+            ]
+            results = list(database.validity.aggregate(pipeline, allowDiskUse=True))
+            if len(results) == 0:
+                return
+            for res in results:
+                bulk_remove.find({'prefix': res['_id'],
+                                  'timestamp': {'$lt': res['cutoff']}}).remove()
+        bulk_remove.execute()
     except Exception as errmsg:
         logging.exception("cleanup_data failed with: " + str(errmsg))
     # end try
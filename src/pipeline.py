@@ -0,0 +1,180 @@
+#!/usr/bin/python
+"""
+Run the complete backend, i.e., BGPmon parser, validator and database writer,
+in a single process. The stages are threads connected by bounded queues, a
+full queue blocks the stage feeding it.
+"""
+import argparse
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from pymongo import MongoClient
+
+# internal imports
+from settings import DEFAULT_LOG_LEVEL, DEFAULT_BGPMON_SERVER, DEFAULT_CACHE_SERVER, \
+                     DEFAULT_MONGO_DATABASE, VALIDATOR_INFLIGHT, HISTORY_RETENTION, \
+                     HISTORY_KEEP, HISTORY_TTL, PIPELINE_QUEUE_SIZE, PIPELINE_FLUSH_INTERVAL, \
+                     BUFFER_POLICY, VALIDATOR_COALESCE_MS, VALIDATOR_COALESCE_MOAS, \
+                     LATEST_PER_PEER, HISTORY_ARCHIVE
+from buffers import StageBuffer, BUFFER_POLICIES
+from bgpmonUpdateParser import recv_bgpmon_rib, recv_bgpmon_updates
+from mongodb import ValidityWriter, StatsEngine, ArchiveWriter, OriginWriter
+from validator import validator, _get_validation_entries, _get_entry_key
+
+class UpdateSplitter(object):
+    """
+    Queue-like sink for the BGPmon receivers, splits each parsed update into
+    validation entries
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def put(self, bgp_message):
+        for entry in _get_validation_entries(bgp_message.__dict__):
+            self.queue.put(entry, bgp_message.rib)
+
+def write_data(database, queue, retention, keep, ttl, per_peer, archive):
+    """
+    Database stage, bulks are written at least every PIPELINE_FLUSH_INTERVAL
+    seconds, stats, origin summaries and optionally the archive are maintained
+    from the written results
+    """
+    logging.info("start database writer")
+    engine = StatsEngine(archive=ArchiveWriter(database) if archive else None,
+                         summaries=OriginWriter(database))
+    writer = ValidityWriter(database, retention, keep, ttl, timeout=PIPELINE_FLUSH_INTERVAL,
+                            per_peer=per_peer, engine=engine)
+    while True:
+        try:
+            data = queue.get(timeout=PIPELINE_FLUSH_INTERVAL)
+        except Empty:
+            data = None
+        if data == 'STOP':
+            break
+        if data is not None:
+            writer.add(data)
+        if writer.due():
+            writer.flush()
+    writer.flush()
+    return True
+
+def _start_thread(target, args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def main():
+    """
+    Parse arguments and start the pipeline stages
+    """
+    parser = argparse.ArgumentParser(description='', epilog='')
+    parser.add_argument('-l', '--loglevel',
+                        help='Set loglevel [DEBUG,INFO,WARNING,ERROR,CRITICAL].',
+                        type=str, default=DEFAULT_LOG_LEVEL)
+    parser.add_argument('-b', '--bgpmon',
+                        help='Address or name of BGPmon host.',
+                        type=str, default=DEFAULT_BGPMON_SERVER['host'])
+    parser.add_argument('-u', '--uport',
+                        help='Port of BGPmon Update XML stream.',
+                        type=int, default=DEFAULT_BGPMON_SERVER['uport'])
+    parser.add_argument('-r', '--ribport',
+                        help='Port of BGPmon RIB XML stream, 0 to disable.',
+                        type=int, default=DEFAULT_BGPMON_SERVER['rport'])
+    parser.add_argument('-a', '--addr',
+                        help='Address or name of RPKI cache server.',
+                        default=DEFAULT_CACHE_SERVER['host'])
+    parser.add_argument('-p', '--port',
+                        help='Port of RPKI cache server.',
+                        default=DEFAULT_CACHE_SERVER['port'], type=int)
+    parser.add_argument('-v', '--vrps',
+                        help='Validate in-process against a VRP dump (JSON or CSV) '
+                        + 'instead of querying the RPKI cache server.',
+                        default=None, type=str)
+    parser.add_argument('-i', '--inflight',
+                        help='Maximum number of queries in flight.',
+                        default=VALIDATOR_INFLIGHT, type=int)
+    parser.add_argument('-c', '--cache-size',
+                        help='Number of cached validation results, 0 to disable, '
+                        + 'by default disabled unless validating against a VRP dump.',
+                        default=None, type=int)
+    parser.add_argument('-t', '--cache-ttl',
+                        help='Lifetime of cached validation results in seconds.',
+                        default=None, type=int)
+    parser.add_argument('-W', '--coalesce-ms',
+                        help='Window in milliseconds to coalesce updates of a prefix '
+                        + 'and peer before validation, 0 to disable.',
+                        default=VALIDATOR_COALESCE_MS, type=int)
+    parser.add_argument('-M', '--moas',
+                        help='Coalesce per prefix, peer and origin AS, '
+                        + 'instead of per prefix and peer.',
+                        action='store_true', default=VALIDATOR_COALESCE_MOAS)
+    parser.add_argument('--buffer-policy',
+                        help='Handling of updates if the validator input is full.',
+                        choices=BUFFER_POLICIES, default=BUFFER_POLICY)
+    parser.add_argument('-m', '--mongodb',
+                        help='MongoDB connection parameters.',
+                        type=str, default=DEFAULT_MONGO_DATABASE['uri'])
+    parser.add_argument('--retention',
+                        help='History retention of validation results.',
+                        choices=['latest', 'last', 'ttl', 'all'],
+                        type=str, default=HISTORY_RETENTION)
+    parser.add_argument('--keep',
+                        help='Number of results kept per prefix, with retention last.',
+                        type=int, default=HISTORY_KEEP)
+    parser.add_argument('--ttl',
+                        help='Lifetime of results in seconds, with retention ttl.',
+                        type=int, default=HISTORY_TTL)
+    parser.add_argument('--per-peer',
+                        help='Keep latest results per BGP peer, not only per prefix and origin.',
+                        action='store_true', default=LATEST_PER_PEER)
+    parser.add_argument('--archive',
+                        help='Record validity state transitions per prefix and origin.',
+                        action='store_true', default=HISTORY_ARCHIVE)
+    args = vars(parser.parse_args())
+
+    numeric_level = getattr(logging, args['loglevel'].upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % args['loglevel'])
+    logging.basicConfig(level=numeric_level,
+                        format='%(asctime)s : %(levelname)s : %(message)s')
+
+    logging.info("START")
+    database = MongoClient(args['mongodb'].strip()).get_default_database()
+    route_queue = StageBuffer('pipeline routes', PIPELINE_QUEUE_SIZE, args['buffer_policy'],
+                              _get_entry_key, Queue(PIPELINE_QUEUE_SIZE))
+    write_queue = StageBuffer('pipeline results', PIPELINE_QUEUE_SIZE,
+                              queue=Queue(PIPELINE_QUEUE_SIZE))
+    splitter = UpdateSplitter(route_queue)
+    addr = args['bgpmon'].strip()
+
+    writer_thread = _start_thread(write_data,
+                                  (database, write_queue.reader(), args['retention'],
+                                   max(1, args['keep']), args['ttl'], args['per_peer'],
+                                   args['archive']))
+    validator_thread = _start_thread(validator,
+                                     (route_queue.reader(), write_queue,
+                                      args['addr'].strip(), str(args['port']),
+                                      args['inflight'], args['vrps'],
+                                      args['cache_size'], args['cache_ttl'],
+                                      args['coalesce_ms'], args['moas']))
+    if args['ribport'] > 0:
+        _start_thread(recv_bgpmon_rib, (addr, args['ribport'], splitter))
+    try:
+        recv_bgpmon_updates(addr, args['uport'], splitter)
+    except KeyboardInterrupt:
+        logging.exception("ABORT")
+    finally:
+        route_queue.put("STOP")
+        validator_thread.join()
+        write_queue.put("STOP")
+        writer_thread.join()
+    logging.info("FINISH")
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,65 @@ DEFAULT_LOG_LEVEL = "CRITICAL"
 
 BULK_MAX_OPS = 10000
 BULK_TIMEOUT = 30
+# history retention in validity: 'latest', 'last' (HISTORY_KEEP per prefix),
+# 'ttl' (HISTORY_TTL seconds) or 'all'
+HISTORY_RETENTION = 'latest'
+HISTORY_KEEP = 10
+HISTORY_TTL = 7*24*3600
+# record validity state transitions per prefix and origin in validity_archive
+HISTORY_ARCHIVE = False
 RIB_TS_INTERVAL = 7200
 SERVICE_INTERVAL = 600
 DOSTATS_INTERVAL = 600
 MAX_COUNTER = 10000
+# encoding between backend stages, 'json' or 'msgpack'
+WIRE_FORMAT = 'json'
+WIRE_FRAME_RECORDS = 1000
+WIRE_FLUSH_INTERVAL = 1
+BGPMON_RECV_BUFSIZE = 65536
+BGPMON_RATE_INTERVAL = 60
+BGPMON_PARSERS = 0
+BGPMON_PARSE_BATCH = 100
+VALIDATOR_INFLIGHT = 64
+# seconds to wait for a cli-validator process to terminate, before it is killed
+VALIDATOR_STOP_TIMEOUT = 5
+VALIDATOR_WORKERS = 1
+VRP_REFRESH_INTERVAL = 60
+# cache of validation results per validator worker, results validated against
+# a VRP dump are dropped as soon as the VRPs change. The cli-validator does not
+# report VRP changes, its results are served stale until they expire, thus in
+# that mode the cache is off by default, and if enabled results expire soon
+VALIDATION_CACHE_SIZE = 200000
+VALIDATION_CACHE_TTL = 3600
+VALIDATION_CACHE_CLI_SIZE = 0
+VALIDATION_CACHE_CLI_TTL = 60
+VALIDATOR_STATS_INTERVAL = 60
+# single process backend (pipeline.py)
+PIPELINE_QUEUE_SIZE = 10000
+PIPELINE_FLUSH_INTERVAL = 0.5
+# bounded buffers between stages, policy of update streams if full:
+# 'block', 'drop-oldest', 'coalesce' (per prefix and peer) or 'spill' (to disk)
+BUFFER_SIZE = 10000
+BUFFER_POLICY = 'block'
+BUFFER_SPILL_DIR = None
+BUFFER_STATS_INTERVAL = 60
+# coalesce updates of a prefix and peer within this window before validation
+VALIDATOR_COALESCE_MS = 0
+VALIDATOR_COALESCE_MOAS = False
+# key validity_latest by prefix, origin and BGP peer, instead of prefix and origin
+LATEST_PER_PEER = False
+# maximum number of invalid prefixes listed in the summary of an origin AS
+ORIGIN_INVALID_MAX = 1000
+# source of the time series of validation stats: 'local' (maintained by the
+# database writer), 'changestream' (requires MongoDB replica set) or 'poll'
+# (DOSTATS_INTERVAL), the IP version rollups are always kept by the writer
+STATS_FEED = 'local'
+STATS_FEEDS = ['local', 'changestream', 'poll']
+STATS_CHECKPOINT_INTERVAL = 30
+# time series of stats in validity_stats, bucket size in seconds and retention
+# in seconds per resolution, 0 to keep forever
+STATS_RESOLUTIONS = [('minute', 60), ('hour', 3600), ('day', 86400)]
+STATS_RETENTION = {'minute': 3*24*3600, 'hour': 180*24*3600, 'day': 0}
+# parallel replay of bgpstreamUpdateParser, shard length in seconds
+REPLAY_SHARD_INTERVAL = 3600
+REPLAY_WORKERS = 4
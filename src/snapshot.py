@@ -0,0 +1,306 @@
+#!/usr/bin/python
+"""
+Columnar snapshot of the latest validation results for analytics, one NumPy
+array per attribute and one row per announced route. Stats, prefix length
+histograms, per origin breakdowns and prefix lookups are computed with
+vectorized operations on the arrays, instead of walking the BSON documents
+of validity_latest. Snapshots can be stored as compressed npz files, and
+rebuilt periodically (--refresh), e.g., for the web frontend to serve the
+IP version stats from (SNAPSHOT_FILE). Requires the optional numpy package.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from pymongo import MongoClient
+
+from settings import DEFAULT_LOG_LEVEL, DEFAULT_MONGO_DATABASE
+from vrptable import parse_prefix, _parse_asn, VALIDITY_STATES
+
+MASK64 = (1 << 64) - 1
+
+# columns and their types, 128 bit addresses are split in two 64 bit halves
+COLUMNS = [('afi', 'uint8'), ('length', 'uint8'),
+           ('start_hi', 'uint64'), ('start_lo', 'uint64'),
+           ('end_hi', 'uint64'), ('end_lo', 'uint64'),
+           ('origin', 'uint32'), ('state', 'uint8'), ('timestamp', 'int64')]
+
+def _split(value):
+    return value >> 64, value & MASK64
+
+def _format_prefix(afi, start_hi, start_lo, length):
+    value = (int(start_hi) << 64) | int(start_lo)
+    if afi == 4:
+        network = socket.inet_ntop(socket.AF_INET, bytearray.fromhex('%08x' % value))
+    else:
+        network = socket.inet_ntop(socket.AF_INET6, bytearray.fromhex('%032x' % value))
+    return network + '/' + str(length)
+
+class Snapshot(object):
+    """
+    Latest validation results as columns, state codes are the index of the
+    state in VALIDITY_STATES, i.e., lower codes take precedence.
+    """
+    def __init__(self, columns, created=None):
+        if np is None:
+            raise ValueError('Snapshots require the numpy package.')
+        self.columns = columns
+        self.created = created or time.time()
+
+    def __len__(self):
+        return len(self.columns['afi'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build snapshot from (prefix, origin, state, timestamp) tuples
+        """
+        rows = dict((name, list()) for name, _ in COLUMNS)
+        for prefix, origin, state, timestamp in records:
+            try:
+                version, value, length = parse_prefix(prefix)
+                asn = _parse_asn(origin)
+                code = VALIDITY_STATES.index(state)
+            except Exception:
+                logging.warning("snapshot, skip invalid route " + str(prefix))
+                continue
+            bits = 32 if version == 4 else 128
+            start_hi, start_lo = _split(value)
+            end_hi, end_lo = _split(value | ((1 << (bits - length)) - 1))
+            rows['afi'].append(version)
+            rows['length'].append(length)
+            rows['start_hi'].append(start_hi)
+            rows['start_lo'].append(start_lo)
+            rows['end_hi'].append(end_hi)
+            rows['end_lo'].append(end_lo)
+            rows['origin'].append(asn)
+            rows['state'].append(code)
+            rows['timestamp'].append(int(timestamp))
+        return cls(dict((name, np.array(rows[name], dtype=dtype))
+                        for name, dtype in COLUMNS))
+
+    @classmethod
+    def from_database(cls, database):
+        """
+        Build snapshot from the announced routes in validity_latest
+        """
+        results = database.validity_latest.find(
+            {'value.type': 'announcement'},
+            {'_id': 0, 'prefix': 1, 'origin': 1, 'value.timestamp': 1,
+             'value.validated_route.validity.state': 1})
+        return cls.from_records((res['prefix'], res['origin'],
+                                 res['value']['validated_route']['validity']['state'],
+                                 res['value']['timestamp']) for res in results)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = dict((name, data[name]) for name, _ in COLUMNS)
+            created = float(data['created'])
+        return cls(columns, created)
+
+    def save(self, path):
+        """
+        Write snapshot to a temporary file and move it in place, readers
+        load either the old or the new snapshot
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix='.snapshot', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.savez_compressed(tmp_file, created=np.array(self.created), **self.columns)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def stats(self):
+        """
+        Per address family: routes per state, and prefix length histograms
+        per state of the prefix, i.e., the best state of its routes. Same
+        layout as the rollups of the backend, plus the address space.
+        """
+        stats = dict()
+        for afi, bits in ((4, 32), (6, 128)):
+            mask = self.afi == afi
+            num = np.bincount(self.state[mask], minlength=len(VALIDITY_STATES))
+            # best state per prefix, rows of a prefix share start and length
+            keys = np.stack((self.start_hi[mask], self.start_lo[mask],
+                             self.length[mask].astype('uint64')), axis=1)
+            prefixes, inverse = np.unique(keys, axis=0, return_inverse=True)
+            best = np.full(len(prefixes), len(VALIDITY_STATES) - 1, dtype='uint8')
+            np.minimum.at(best, inverse.ravel(), self.state[mask])
+            hist = np.zeros((len(VALIDITY_STATES), bits + 1), dtype='int64')
+            np.add.at(hist, (best, prefixes[:, 2].astype('intp')), 1)
+            afi_stats = dict()
+            for code, state in enumerate(VALIDITY_STATES):
+                afi_stats['num_' + state] = int(num[code])
+                afi_stats['len_' + state] = hist[code].tolist()
+                # python integers, IPv6 address space exceeds 64 bit
+                afi_stats['ips_' + state] = sum(count << (bits - length) for length, count
+                                                in enumerate(afi_stats['len_' + state]))
+            stats['ipv' + str(afi)] = afi_stats
+        return stats
+
+    def origins(self):
+        """
+        Returns sorted origin ASNs and a matching array of route counts
+        per state
+        """
+        asns, inverse = np.unique(self.origin, return_inverse=True)
+        counts = np.zeros((len(asns), len(VALIDITY_STATES)), dtype='int64')
+        np.add.at(counts, (inverse.ravel(), self.state), 1)
+        return asns, counts
+
+    def origin_stats(self, asn):
+        asn = _parse_asn(asn)
+        num = np.bincount(self.state[self.origin == asn], minlength=len(VALIDITY_STATES))
+        return dict(('num_' + state, int(num[code]))
+                    for code, state in enumerate(VALIDITY_STATES))
+
+    def _query(self, prefix):
+        version, value, length = parse_prefix(prefix)
+        bits = 32 if version == 4 else 128
+        start = _split(value)
+        end = _split(value | ((1 << (bits - length)) - 1))
+        return version, length, start, end
+
+    def _compare(self, name, value):
+        """
+        Returns masks (column <= value, column >= value) of a 128 bit
+        address column, i.e., 'start' or 'end', and a (hi, lo) value
+        """
+        hi = self.columns[name + '_hi']
+        lo = self.columns[name + '_lo']
+        value_hi = np.uint64(value[0])
+        value_lo = np.uint64(value[1])
+        less_equal = (hi < value_hi) | ((hi == value_hi) & (lo <= value_lo))
+        greater_equal = (hi > value_hi) | ((hi == value_hi) & (lo >= value_lo))
+        return less_equal, greater_equal
+
+    def covering(self, prefix):
+        """
+        Returns row indexes of routes covering the prefix, including itself
+        """
+        version, length, start, end = self._query(prefix)
+        start_le = self._compare('start', start)[0]
+        end_ge = self._compare('end', end)[1]
+        mask = (self.afi == version) & (self.length <= length) & start_le & end_ge
+        return np.nonzero(mask)[0]
+
+    def covered(self, prefix):
+        """
+        Returns row indexes of routes covered by the prefix, including itself
+        """
+        version, length, start, end = self._query(prefix)
+        start_ge = self._compare('start', start)[1]
+        end_le = self._compare('end', end)[0]
+        mask = (self.afi == version) & (self.length >= length) & start_ge & end_le
+        return np.nonzero(mask)[0]
+
+    def rows(self, indexes):
+        """
+        Returns routes at the given row indexes as dicts
+        """
+        return [{'prefix': _format_prefix(self.afi[i], self.start_hi[i], self.start_lo[i],
+                                          self.length[i]),
+                 'origin': 'AS' + str(self.origin[i]),
+                 'state': VALIDITY_STATES[self.state[i]],
+                 'timestamp': int(self.timestamp[i])} for i in indexes]
+
+def refresh(dbconnstr, path, interval):
+    """
+    Rebuild the snapshot from the database every interval seconds and
+    store it
+    """
+    database = MongoClient(dbconnstr).get_default_database()
+    while True:
+        begin = time.time()
+        try:
+            snapshot = Snapshot.from_database(database)
+            snapshot.save(path)
+            logging.info("snapshot of " + str(len(snapshot)) + " routes, took " +
+                         str(round(time.time() - begin, 1)) + "s")
+        except Exception as errmsg:
+            logging.exception("refresh snapshot, failed with: " + str(errmsg))
+        # end try
+        time.sleep(max(0, interval - (time.time() - begin)))
+
+def main():
+    """
+    Create a snapshot from the database or load it from a file, print
+    stats and optionally store it
+    """
+    parser = argparse.ArgumentParser(description='', epilog='')
+    parser.add_argument('-l', '--loglevel',
+                        help='Set loglevel [DEBUG,INFO,WARNING,ERROR,CRITICAL].',
+                        type=str, default=DEFAULT_LOG_LEVEL)
+    parser.add_argument('-m', '--mongodb',
+                        help='MongoDB connection parameters.',
+                        type=str, default=DEFAULT_MONGO_DATABASE['uri'])
+    parser.add_argument('-i', '--input',
+                        help='Load snapshot from npz file instead of the database.',
+                        type=str, default=None)
+    parser.add_argument('-o', '--output',
+                        help='Store snapshot as npz file.',
+                        type=str, default=None)
+    parser.add_argument('-a', '--asn',
+                        help='Print stats of an origin AS.',
+                        type=str, default=None)
+    parser.add_argument('-p', '--prefix',
+                        help='Print routes covering and covered by an IP prefix.',
+                        type=str, default=None)
+    parser.add_argument('-r', '--refresh',
+                        help='Rebuild the snapshot from the database every given seconds '
+                        + 'and store it, requires output.',
+                        type=int, default=0)
+    args = vars(parser.parse_args())
+
+    numeric_level = getattr(logging, args['loglevel'].upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % args['loglevel'])
+    logging.basicConfig(level=numeric_level,
+                        format='%(asctime)s : %(levelname)s : %(message)s')
+
+    if args['refresh'] > 0:
+        if args['output'] is None:
+            parser.error('refresh requires output')
+        refresh(args['mongodb'].strip(), args['output'], args['refresh'])
+        return
+    if args['input'] is not None:
+        snapshot = Snapshot.load(args['input'])
+    else:
+        database = MongoClient(args['mongodb'].strip()).get_default_database()
+        snapshot = Snapshot.from_database(database)
+    logging.info("snapshot of " + str(len(snapshot)) + " routes")
+    if args['output'] is not None:
+        snapshot.save(args['output'])
+    if args['asn'] is not None:
+        result = snapshot.origin_stats(args['asn'])
+    elif args['prefix'] is not None:
+        result = {'covering': snapshot.rows(snapshot.covering(args['prefix'])),
+                  'covered': snapshot.rows(snapshot.covered(args['prefix']))}
+    else:
+        result = snapshot.stats()
+    print(json.dumps(result, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
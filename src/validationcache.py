@@ -0,0 +1,83 @@
+"""
+Cache of validation results keyed by (prefix, origin ASN)
+"""
+import time
+
+from collections import OrderedDict
+
+from vrptable import PrefixTrie, parse_prefix
+
+class ValidationCache(object):
+    """
+    Bounded LRU cache of validity results, entries expire after `ttl`
+    seconds (0 = never). The cache is bound to the serial of the VRP set it
+    was filled from, see sync().
+    """
+    def __init__(self, size, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.serial = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, prefix, asn):
+        """
+        Returns cached validity of (prefix, asn) or None
+        """
+        key = (prefix, asn)
+        entry = self.entries.pop(key, None)
+        if entry is None or (self.ttl > 0 and entry[1] < time.time()):
+            self.misses += 1
+            return None
+        # re-insert to mark as most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, prefix, asn, validity):
+        key = (prefix, asn)
+        self.entries.pop(key, None)
+        self.entries[key] = (validity, time.time() + self.ttl)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def invalidate(self, prefixes):
+        """
+        Drop all entries for routes covered by any of the given prefixes
+        """
+        tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for prefix in prefixes:
+            version, value, length = parse_prefix(prefix)
+            tries[version].insert(value, length, prefix)
+        for key in list(self.entries.keys()):
+            version, value, length = parse_prefix(key[0])
+            if len(tries[version].covering(value, length)) > 0:
+                del self.entries[key]
+
+    def sync(self, serial, prefixes=None):
+        """
+        Bind cache to VRP set serial, if the serial changed drop entries
+        covered by the changed VRP prefixes, or all entries if not given.
+        """
+        if serial == self.serial:
+            return
+        if self.serial is None or prefixes is None:
+            self.clear()
+        else:
+            self.invalidate(prefixes)
+        self.serial = serial
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        ratio = 0.0
+        if lookups > 0:
+            ratio = round(float(self.hits) / float(lookups) * 100, 2)
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'hit_ratio': ratio}
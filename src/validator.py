@@ -6,12 +6,63 @@ import gc
 import json
 import logging
 import sys
+import threading
+import time
+import zlib
 
 import multiprocessing as mp
+from collections import deque, OrderedDict
 from subprocess import PIPE, Popen
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
 
 # internal imports
 from settings import *
+from validationcache import ValidationCache
+from vrptable import RouteTable, VRPTable
+from buffers import StageBuffer, BUFFER_POLICIES
+from wire import WireReader, WireWriter, WIRE_FORMATS
+
+def _fill_validity(validity, code, vlength, vasn, reasons):
+    """
+    Fill in response information from a validation result code and the
+    covering VRPs, given as (asn, prefix, length, max length) strings
+    """
+    validity['code'] = code
+    validity['VRPs'] = dict()
+    validity['VRPs']['matched'] = list()
+    validity['VRPs']['unmatched_as'] = list()
+    validity['VRPs']['unmatched_length'] = list()
+    if validity['code'] != 1:
+        for rasn, rprefix, rmin_len, rmax_len in reasons:
+            vrp = dict()
+            vrp['asn'] = "AS"+rasn
+            vrp['prefix'] = rprefix+"/"+rmin_len
+            vrp['max_length'] = rmax_len
+            match = True
+            if vasn != rasn:
+                validity['VRPs']['unmatched_as'].append(vrp)
+                match = False
+            elif int(vlength) > int(rmax_len):
+                validity['VRPs']['unmatched_length'].append(vrp)
+                match = False
+            if match:
+                validity['VRPs']['matched'].append(vrp)
+        # END (for r in reasons)
+        if validity['code'] == 2:
+            if len(validity['VRPs']['unmatched_as']) > 0:
+                validity['code'] = 3
+                validity['reason'] = 'as'
+            if len(validity['VRPs']['unmatched_length']) > 0:
+                validity['code'] = 4
+                validity['reason'] = 'length'
+        # END (if validity['code'] == 2)
+    # END (if validity['code'] != 1)
+    validity['state'] = VALIDITY_STATE[validity['code']]
+    validity['description'] = VALIDITY_DESCR[validity['code']]
+    return validity
 
 def _get_validity(validation_result_string):
     """
@@ -39,111 +90,554 @@ def _get_validity(validation_result_string):
     else: # looks like a valid validation result string
         query = validation_result_array[0]
         reasons = validation_result_array[1]
-        validity['code'] = int(validation_result_array[2])
-
-        validity['VRPs'] = dict()
-        validity['VRPs']['matched'] = list()
-        validity['VRPs']['unmatched_as'] = list()
-        validity['VRPs']['unmatched_length'] = list()
-        if validity['code'] != 1:
-            reasons_array = reasons.split(',')
+        code = int(validation_result_array[2])
+        vlength = vasn = None
+        reasons_array = list()
+        if code != 1:
             vprefix, vlength, vasn = query.split()
-            for reason in reasons_array:
-                rasn, rprefix, rmin_len, rmax_len = reason.split()
-                vrp = dict()
-                vrp['asn'] = "AS"+rasn
-                vrp['prefix'] = rprefix+"/"+rmin_len
-                vrp['max_length'] = rmax_len
-                match = True
-                if vasn != rasn:
-                    validity['VRPs']['unmatched_as'].append(vrp)
-                    match = False
-                elif vlength > rmax_len:
-                    validity['VRPs']['unmatched_length'].append(vrp)
-                    match = False
-                if match:
-                    validity['VRPs']['matched'].append(vrp)
-            # END (for r in reasons_array)
-            if validity['code'] == 2:
-                if len(validity['VRPs']['unmatched_as']) > 0:
-                    validity['code'] = 3
-                    validity['reason'] = 'as'
-                if len(validity['VRPs']['unmatched_length']) > 0:
-                    validity['code'] = 4
-                    validity['reason'] = 'length'
-            # END (if validity['code'] == 2)
-        # END (if validity['code'] != 1)
-        validity['state'] = VALIDITY_STATE[validity['code']]
-        validity['description'] = VALIDITY_DESCR[validity['code']]
+            reasons_array = [reason.split() for reason in reasons.split(',')]
+        _fill_validity(validity, code, vlength, vasn, reasons_array)
     # END (if elif else)
     return validity
 
-def validator(ipipe, opipe, cache_host, cache_port):
+def _get_announcement(validation_entry, validity):
+    """
+    Build the announcement record for a validated route
+    """
+    return_data = dict()
+    return_data['route'] = dict()
+    return_data['route']['origin_asn'] = "AS"+validation_entry[1]
+    return_data['route']['prefix'] = validation_entry[0]
+    return_data['validity'] = validity
+    record = {
+        "type": "announcement",
+        "prefix": validation_entry[0],
+        "timestamp": validation_entry[2],
+        "validated_route": return_data
+    }
+    if validation_entry[3] is not None:
+        record['source'] = validation_entry[3]
+    return record
+
+def _read_responses(stdout, responses):
+    """
+    Move the output of a cli-validator process line by line into a queue,
+    None marks its end
+    """
+    for line in iter(stdout.readline, ''):
+        responses.put(line)
+    stdout.close()
+    responses.put(None)
+
+class ValidationSession(object):
+    """
+    A cli-validator subprocess with up to `inflight` queries outstanding,
+    responses are matched to their requests by the echoed query field.
+    Responses are read by a separate thread while queries are written,
+    otherwise with a large window both pipes fill up and block each other.
+    """
+    def __init__(self, cache_host, cache_port, inflight, cache=None):
+        self.cache = cache
+        self.cache_host = cache_host
+        self.cache_port = cache_port
+        self.cache_cmd = [VALIDATOR_PATH, cache_host, cache_port]
+        self.inflight = max(1, inflight)
+        # entries [validation_entry, query, record] in input order
+        self.pending = deque()
+        # query -> entries still waiting for a response
+        self.waiting = dict()
+        self.num_waiting = 0
+        self.process = None
+        self.responses = None
+        self._start()
+
+    def _start(self):
+        """
+        (Re)start the subprocess and resend all unanswered queries
+        """
+        self._stop()
+        self.process = Popen(self.cache_cmd, stdin=PIPE, stdout=PIPE,
+                             universal_newlines=True)
+        self.responses = Queue()
+        reader = threading.Thread(target=_read_responses,
+                                  args=(self.process.stdout, self.responses))
+        reader.daemon = True
+        reader.start()
+        for entry in self.pending:
+            if entry[2] is None:
+                self.process.stdin.write(entry[1] + '\n')
+
+    def _stop(self):
+        """
+        Terminate the subprocess, if still running, and reap it. Its output
+        is closed by the reader thread once drained.
+        """
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            deadline = time.time() + VALIDATOR_STOP_TIMEOUT
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+        self.process.wait()
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            # unflushed queries of a dead process, they are resent
+            pass
+        self.process = None
+
+    def full(self):
+        return self.num_waiting >= self.inflight
+
+    def idle(self):
+        return self.num_waiting == 0
+
+    def submit(self, validation_entry):
+        """
+        Send a (prefix, asn, timestamp) query to the validator
+        """
+        network, masklen = validation_entry[0].split('/')
+        asn = validation_entry[1]
+        if self.cache is not None:
+            validity = self.cache.get(validation_entry[0], asn)
+            if validity is not None:
+                self.defer(_get_announcement(validation_entry, validity))
+                return
+        query = str(network) + " " + str(masklen) + " " + str(asn)
+        entry = [validation_entry, query, None]
+        self.pending.append(entry)
+        self.waiting.setdefault(query, deque()).append(entry)
+        self.num_waiting += 1
+        if self.process.poll() is not None:
+            self._start()
+        else:
+            self.process.stdin.write(query + '\n')
+
+    def defer(self, record):
+        """
+        Queue a record that needs no validation, e.g. a withdraw, such that
+        it is emitted in order with the validation results.
+        """
+        self.pending.append([None, None, record])
+
+    def receive(self):
+        """
+        Read one response and assign it to its query, blocks until the
+        validator answers.
+        """
+        self.process.stdin.flush()
+        validation_result = self.responses.get()
+        if validation_result is None:
+            logging.warning("validator process died, restarting ...")
+            self._start()
+            return
+        validation_result = validation_result.strip()
+        query = validation_result.split("|")[0]
+        if query in self.waiting:
+            entries = self.waiting[query]
+            entry = entries.popleft()
+            if len(entries) == 0:
+                del self.waiting[query]
+        else:
+            # error responses do not echo the query, blame the oldest one
+            entry = next(e for e in self.pending if e[2] is None)
+            entries = self.waiting[entry[1]]
+            entries.remove(entry)
+            if len(entries) == 0:
+                del self.waiting[entry[1]]
+        validation_entry = entry[0]
+        validity = _get_validity(validation_result)
+        logging.debug(self.cache_host+":" +self.cache_port+ " -> " +validation_entry[0]+
+                      "(AS"+validation_entry[1]+") -> " +validity['state'])
+        if self.cache is not None and validity['code'] < 100:
+            self.cache.put(validation_entry[0], validation_entry[1], validity)
+        entry[2] = _get_announcement(validation_entry, validity)
+        self.num_waiting -= 1
+
+    def completed(self):
+        """
+        Return finished output records in input order
+        """
+        records = list()
+        while len(self.pending) > 0 and self.pending[0][2] is not None:
+            records.append(self.pending.popleft()[2])
+        return records
+
+    def refresh(self):
+        return None
+
+    def close(self):
+        self._stop()
+
+class VRPSession(object):
+    """
+    Same interface as ValidationSession, but validates against an in-process
+    VRP table, i.e., without any per-prefix IPC. Keeps a table of announced
+    routes to re-validate those affected by VRP changes.
+    """
+    def __init__(self, vrp_table, inflight, cache=None):
+        self.cache = cache
+        if cache is not None:
+            cache.sync(vrp_table.serial)
+        self.vrp_table = vrp_table
+        self.route_table = RouteTable()
+        self.inflight = max(1, inflight)
+        self.pending = list()
+        self.last_refresh = time.time()
+
+    def full(self):
+        return len(self.pending) >= self.inflight
+
+    def idle(self):
+        return True
+
+    def submit(self, validation_entry):
+        self.route_table.announce(*validation_entry[:4])
+        validity = None
+        if self.cache is not None:
+            validity = self.cache.get(validation_entry[0], validation_entry[1])
+        if validity is None:
+            validity = self._validate(validation_entry)
+        self.pending.append(_get_announcement(validation_entry, validity))
+
+    def _validate(self, validation_entry):
+        try:
+            code, reasons = self.vrp_table.validate(validation_entry[0],
+                                                    validation_entry[1])
+        except Exception as errmsg:
+            logging.error(" !! validator: invalid query, " + str(errmsg))
+            validity = _get_validity("input error")
+        else:
+            masklen = validation_entry[0].split('/')[1]
+            validity = _fill_validity(dict(), code, masklen,
+                                      validation_entry[1], reasons)
+            if self.cache is not None:
+                self.cache.put(validation_entry[0], validation_entry[1], validity)
+        return validity
+
+    def defer(self, record):
+        if record['type'] == 'withdraw':
+            self.route_table.withdraw(record['prefix'], record.get('source'))
+        self.pending.append(record)
+
+    def receive(self):
+        pass
+
+    def completed(self):
+        records = self.pending
+        self.pending = list()
+        return records
+
+    def refresh(self):
+        """
+        Reload the VRP table every VRP_REFRESH_INTERVAL seconds, and
+        re-validate all routes covered by added or removed VRPs
+        """
+        now = time.time()
+        if now - self.last_refresh < VRP_REFRESH_INTERVAL:
+            return None
+        self.last_refresh = now
+        delta = self.vrp_table.refresh()
+        if delta is None:
+            return None
+        changed = set(vrp[1] for vrp in delta[0] | delta[1])
+        if self.cache is not None:
+            self.cache.sync(self.vrp_table.serial, changed)
+        routes = self.route_table.covered(changed)
+        logging.info("VRP serial " + str(self.vrp_table.serial) + ", re-validate " +
+                     str(len(routes)) + " routes")
+        for validation_entry in routes:
+            # keep the BGP timestamp of the route, such that later BGP
+            # updates of the route still supersede the new result
+            validity = self._validate(validation_entry)
+            record = _get_announcement(validation_entry, validity)
+            record['revalidated'] = int(now)
+            self.pending.append(record)
+        return delta
+
+    def close(self):
+        pass
+
+class UpdateCoalescer(object):
+    """
+    Hold validation entries for `window` seconds and keep only the latest
+    entry per prefix and BGP peer, or per (prefix, peer, origin) if moas is
+    set, superseded entries are counted but not validated. As a peer has a
+    single route per prefix, its latest entry replaces all earlier ones. With
+    moas a withdraw supersedes the pending entries of all origins of its
+    prefix and peer. Entries of RIB dumps are never coalesced.
+    """
+    def __init__(self, window, moas=False):
+        self.window = window
+        self.moas = moas
+        # key -> [due time, entry], in order of arrival
+        self.entries = OrderedDict()
+        # (prefix, peer) -> keys of pending entries, only with moas
+        self.keys = dict()
+        self.superseded = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, entry):
+        route = _get_entry_key(entry)
+        if self.moas:
+            origin = None if isinstance(entry, dict) else entry[1]
+            return route, route + (origin,)
+        return route, route
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)[1]
+        if self.moas:
+            keys = self.keys[key[:2]]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.keys[key[:2]]
+        return entry
+
+    def _pop_route(self, route):
+        """
+        Remove and return the pending entries of a prefix and peer, in order
+        """
+        if not self.moas:
+            if route not in self.entries:
+                return []
+            return [self._remove(route)]
+        keys = self.keys.get(route)
+        if keys is None:
+            return []
+        return [self._remove(key) for key in [key for key in self.entries if key in keys]]
+
+    def add(self, entry):
+        """
+        Hold an entry, returns the entries to dispatch right away, i.e., for
+        an entry of a RIB dump the pending entries of its prefix and peer
+        followed by the entry itself, to keep the updates of a route in order
+        """
+        route, key = self._key(entry)
+        if not isinstance(entry, dict) and entry[4]:
+            ready = self._pop_route(route)
+            ready.append(entry)
+            return ready
+        if self.moas and isinstance(entry, dict):
+            for other in list(self.keys.get(route, ())):
+                if other != key:
+                    self._remove(other)
+                    self.superseded += 1
+        pending = self.entries.get(key)
+        if pending is not None:
+            self.superseded += 1
+            if not self.moas:
+                pending[1] = entry
+                return []
+            # behind the pending entries of other origins of the peer, as
+            # the latest entry of a peer replaces its route
+            self._remove(key)
+            due = pending[0]
+        else:
+            due = time.time() + self.window
+        self.entries[key] = [due, entry]
+        if self.moas:
+            self.keys.setdefault(route, set()).add(key)
+        return []
+
+    def wait(self):
+        """
+        Returns seconds until the oldest entry is due
+        """
+        due = next(iter(self.entries.values()))[0]
+        return max(0, due - time.time())
+
+    def pop_due(self):
+        """
+        Returns the oldest entry if it is due, otherwise None
+        """
+        if len(self.entries) == 0:
+            return None
+        key, pending = next(iter(self.entries.items()))
+        if pending[0] > time.time():
+            return None
+        return self._remove(key)
+
+    def drain(self):
+        while len(self.entries) > 0:
+            yield self._remove(next(iter(self.entries.keys())))
+
+def _dispatch(session, validation_entry):
+    """
+    Pass a withdraw record or validation entry to the session
+    """
+    if isinstance(validation_entry, dict):
+        session.defer(validation_entry)
+    elif len(validation_entry) < 5:
+        logging.error(" !! validator: failed to parse query !!")
+    else:
+        session.submit(validation_entry)
+
+def _get_cache(vrp_file, cache_size, cache_ttl):
+    """
+    Returns the validation cache of a worker or None if disabled, size and
+    lifetime default to the settings of the validation mode
+    """
+    if vrp_file is not None:
+        defaults = (VALIDATION_CACHE_SIZE, VALIDATION_CACHE_TTL)
+    else:
+        # results of the cli-validator are not invalidated on VRP changes
+        defaults = (VALIDATION_CACHE_CLI_SIZE, VALIDATION_CACHE_CLI_TTL)
+    if cache_size is None:
+        cache_size = defaults[0]
+    if cache_ttl is None:
+        cache_ttl = defaults[1]
+    if cache_size <= 0:
+        return None
+    return ValidationCache(cache_size, cache_ttl)
+
+def validator(ipipe, oqueue, cache_host, cache_port, inflight, vrp_file=None,
+              cache_size=None, cache_ttl=None, coalesce_ms=0, moas=False):
     """
     The validation thread, this is where the work is done.
     """
     logging.info("start validator thread")
-    # start RPKI validation client process
-    cache_cmd = [VALIDATOR_PATH, cache_host, cache_port]
-    validator_process = Popen(cache_cmd, stdin=PIPE, stdout=PIPE)
-    logging.info("run validator thread (" + cache_host + ":" + cache_port + ")")
+    cache = _get_cache(vrp_file, cache_size, cache_ttl)
+    if vrp_file is not None:
+        # validate in-process against a local VRP table
+        session = VRPSession(VRPTable(vrp_file), inflight, cache)
+        logging.info("run validator thread (" + vrp_file + ")")
+    else:
+        # start RPKI validation client process
+        session = ValidationSession(cache_host, cache_port, inflight, cache)
+        logging.info("run validator thread (" + cache_host + ":" + cache_port + ")")
+    coalescer = None
+    if coalesce_ms > 0:
+        coalescer = UpdateCoalescer(coalesce_ms / 1000.0, moas)
+    last_stats = time.time()
     run = True
     while run:
-        validation_entry = ipipe.recv()
-        if validation_entry == "STOP":
-            run = False
-            break
-        if len(validation_entry) < 3:
-            logging.error(" !! validator: failed to parse query !!")
-            continue
-        network, masklen = validation_entry[0].split('/')
-        asn = validation_entry[1]
-        bgp_entry_str = str(network) + " " + str(masklen) + " " + str(asn)
-        if validator_process.poll() is not None:
-            validator_process = Popen(cache_cmd, stdin=PIPE, stdout=PIPE)
-        validator_process.stdin.write(bgp_entry_str + '\n')
-        validation_result = validator_process.stdout.readline().strip()
-        validity = _get_validity(validation_result)
-        logging.debug(cache_host+":" +cache_port+ " -> " +validation_entry[0]+
-                      "(AS"+asn+") -> " +validity['state'])
-        return_data = dict()
-        return_data['route'] = dict()
-        return_data['route']['origin_asn'] = "AS"+asn
-        return_data['route']['prefix'] = validation_entry[0]
-        return_data['validity'] = validity
-        opipe.send({
-            "type": "announcement",
-            "prefix": validation_entry[0],
-            "timestamp": validation_entry[2],
-            "validated_route": return_data
-        })
+        # fill the window, only wait on input if nothing is in flight
+        timeout = 1 if session.idle() else 0
+        if timeout > 0 and coalescer is not None and len(coalescer) > 0:
+            timeout = min(timeout, coalescer.wait())
+        while not session.full():
+            if coalescer is not None:
+                validation_entry = coalescer.pop_due()
+                if validation_entry is not None:
+                    _dispatch(session, validation_entry)
+                    continue
+            if not ipipe.poll(timeout):
+                break
+            timeout = 0
+            validation_entry = ipipe.recv()
+            if validation_entry == "STOP":
+                run = False
+                break
+            if coalescer is not None:
+                for ready in coalescer.add(validation_entry):
+                    _dispatch(session, ready)
+            else:
+                _dispatch(session, validation_entry)
+        # end while
+        if not run:
+            if coalescer is not None:
+                for validation_entry in coalescer.drain():
+                    while session.full():
+                        session.receive()
+                        for record in session.completed():
+                            oqueue.put(record)
+                    _dispatch(session, validation_entry)
+            while not session.idle():
+                session.receive()
+        elif not session.idle():
+            session.receive()
+        for record in session.completed():
+            oqueue.put(record)
+        session.refresh()
+        if time.time() - last_stats > VALIDATOR_STATS_INTERVAL:
+            last_stats = time.time()
+            if cache is not None:
+                logging.info("validation cache: " + json.dumps(cache.stats()))
+            if coalescer is not None:
+                logging.info("coalescer: " + str(coalescer.superseded) + " superseded, " +
+                             str(len(coalescer)) + " pending")
     # end while
-    validator_process.kill()
+    session.close()
     return True
 
-def output(pipe, format_json):
+def output(queue, format_json, wire_format='json'):
     """
     Output validation result as one line JSON, pretty JSON formatting is optional
     """
     logging.info("start output")
+    writer = WireWriter(sys.stdout, wire_format, format_json)
     while True:
-        odata = pipe.recv()
+        try:
+            odata = queue.get(timeout=WIRE_FLUSH_INTERVAL)
+        except Empty:
+            writer.flush()
+            continue
         if odata == 'STOP':
-            print(odata)
-            sys.stdout.flush()
+            writer.write(odata)
+            writer.flush()
             break
         try:
-            if format_json:
-                print(json.dumps(odata, sort_keys=True, indent=2, separators=(',', ': ')))
-            else:
-                print(json.dumps(odata))
-            # end if
-            sys.stdout.flush()
+            writer.write(odata)
         except Exception as errmsg:
             logging.exception("output, failed with: " + str(errmsg))
         # end try
     return True
 
+def _get_validation_entries(data):
+    """
+    Split a parsed BGP update into withdraw records and (prefix, origin,
+    timestamp, source, rib) validation entries, both carry the BGP peer as
+    source, which is None if not known, rib is set for entries of RIB dumps
+    """
+    entries = list()
+    if data['type'] != 'update':
+        return entries
+    source = data.get('source')
+    for wdraw in data['withdraw']:
+        record = {
+            "type": "withdraw",
+            "prefix": wdraw,
+            "timestamp": data['timestamp']
+        }
+        if source is not None:
+            record['source'] = source
+        entries.append(record)
+    path = data['aspath']
+    if len(path) > 0:
+        origin = path[-1]
+        for pre in data['announce']:
+            logging.debug(pre + " : " + origin)
+            entries.append((pre, origin, data['timestamp'], source, data.get('rib', False)))
+    return entries
+
+def _get_entry_prefix(entry):
+    """
+    Returns the prefix of a withdraw record or validation entry
+    """
+    if isinstance(entry, dict):
+        return entry['prefix']
+    return entry[0]
+
+def _get_entry_key(entry):
+    """
+    Returns (prefix, source) of a withdraw record or validation entry, i.e.,
+    the route it replaces
+    """
+    if isinstance(entry, dict):
+        return entry['prefix'], entry.get('source')
+    return entry[0], entry[3]
+
+def _get_shard(prefix, num_shards):
+    """
+    Map a prefix to a validator worker, stable across processes and runs
+    """
+    return (zlib.crc32(prefix.encode('ascii')) & 0xffffffff) % num_shards
+
 def main():
     """
     The main loop, parsing arguments and start input and output threads
@@ -161,6 +655,41 @@ def main():
     parser.add_argument('-j', '--json',
                         help='Format JSON output nicely.',
                         action='store_true')
+    parser.add_argument('-i', '--inflight',
+                        help='Maximum number of queries in flight per validator.',
+                        default=VALIDATOR_INFLIGHT, type=int)
+    parser.add_argument('-w', '--workers',
+                        help='Number of validator processes, sharded by prefix.',
+                        default=VALIDATOR_WORKERS, type=int)
+    parser.add_argument('-v', '--vrps',
+                        help='Validate in-process against a VRP dump (JSON or CSV) '
+                        + 'instead of querying the RPKI cache server.',
+                        default=None, type=str)
+    parser.add_argument('-c', '--cache-size',
+                        help='Number of cached validation results per worker, 0 to disable, '
+                        + 'by default disabled unless validating against a VRP dump.',
+                        default=None, type=int)
+    parser.add_argument('-t', '--cache-ttl',
+                        help='Lifetime of cached validation results in seconds, '
+                        + 'results validated against a VRP dump are dropped on VRP changes.',
+                        default=None, type=int)
+    parser.add_argument('-W', '--coalesce-ms',
+                        help='Window in milliseconds to coalesce updates of a prefix '
+                        + 'and peer before validation, 0 to disable.',
+                        default=VALIDATOR_COALESCE_MS, type=int)
+    parser.add_argument('-M', '--moas',
+                        help='Coalesce per prefix, peer and origin AS, '
+                        + 'instead of per prefix and peer.',
+                        action='store_true', default=VALIDATOR_COALESCE_MOAS)
+    parser.add_argument('-b', '--buffer-policy',
+                        help='Handling of updates if the input buffer of a validator is full.',
+                        choices=BUFFER_POLICIES, default=BUFFER_POLICY)
+    parser.add_argument('-s', '--buffer-size',
+                        help='Number of buffered records per stage.',
+                        default=BUFFER_SIZE, type=int)
+    parser.add_argument('--wire',
+                        help='Encoding of input and output records.',
+                        choices=WIRE_FORMATS, default=WIRE_FORMAT)
     args = vars(parser.parse_args())
 
     numeric_level = getattr(logging, args['loglevel'].upper(), None)
@@ -171,56 +700,50 @@ def main():
 
     addr = args['addr'].strip()
     port = args['port']
+    num_workers = max(1, args['workers'])
 
     # BEGIN
     logging.info("START")
     # init queues
-    ipipe_recv, ipipe_send = mp.Pipe(False)
-    opipe_recv, opipe_send = mp.Pipe(False)
-    # start validator thread
-    val_thread = mp.Process(target=validator,
-                            args=(ipipe_recv, opipe_send, addr, str(port)))
-    val_thread.start()
+    output_queue = StageBuffer('validator output', args['buffer_size'])
+    ipipes = list()
+    val_threads = list()
+    # start validator threads, each with its own cache connection
+    for num in range(num_workers):
+        ipipe = StageBuffer('validator input ' + str(num), args['buffer_size'],
+                            args['buffer_policy'], _get_entry_key)
+        val_thread = mp.Process(target=validator,
+                                args=(ipipe.reader(), output_queue, addr, str(port),
+                                      args['inflight'], args['vrps'],
+                                      args['cache_size'], args['cache_ttl'],
+                                      args['coalesce_ms'], args['moas']))
+        val_thread.start()
+        ipipes.append(ipipe)
+        val_threads.append(val_thread)
     # start output thread
     out_thread = mp.Process(target=output,
-                            args=(opipe_recv, args['json']))
+                            args=(output_queue.reader(), args['json'], args['wire']))
     out_thread.start()
     # main loop, reading from STDIN
-    while True:
-        line = sys.stdin.readline().strip()
-        if line.strip() == 'STOP':
+    for data in WireReader(sys.stdin, args['wire']):
+        if data == 'STOP':
             break
         # end if
-        try:
-            data = json.loads(line)
-        except:
-            logging.exception("Failed to parse JSON from input.")
-        else:
-            if data['type'] == 'update':
-                withdraws = data['withdraw']
-                for wdraw in withdraws:
-                    opipe_send.send({
-                        "type": "withdraw",
-                        "prefix": wdraw,
-                        "timestamp": data['timestamp']
-                    })
-                path = data['aspath']
-                if len(path) < 1:
-                    continue
-                origin = path[-1]
-                prefixes = data['announce']
-                for pre in prefixes:
-                    logging.debug(pre + " : " + origin)
-                    ipipe_send.send((pre, origin, data['timestamp']))
-                # end for
-            # end if type
-        # end try
-    # end while
+        # withdraws pass the same worker as announcements, to keep
+        # updates of a prefix in order, entries of RIB dumps are never
+        # dropped or coalesced by the buffer policy
+        keep = data.get('rib', False)
+        for entry in _get_validation_entries(data):
+            ipipes[_get_shard(_get_entry_prefix(entry), num_workers)].put(entry, keep)
+        # end for
+    # end for
     # we should not get here, but just in case we stop everything gracefully
-    ipipe_send.send("STOP")
-    opipe_send.send("STOP")
+    for ipipe in ipipes:
+        ipipe.put("STOP")
+    for val_thread in val_threads:
+        val_thread.join()
+    output_queue.put("STOP")
     out_thread.join()
-    val_thread.join()
     logging.info("FINISH")
 
 if __name__ == "__main__":
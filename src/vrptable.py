@@ -0,0 +1,275 @@
+"""
+In-process RPKI origin validation (RFC 6811) against a VRP table held in
+binary prefix tries, an alternative to the cli-validator subprocess.
+"""
+import csv
+import json
+import logging
+import os
+import socket
+
+from array import array
+from binascii import hexlify
+
+# validity states, in order of precedence for the state of a prefix
+VALIDITY_STATES = ['Valid', 'InvalidLength', 'InvalidAS', 'NotFound']
+# states of a route in validity_archive, encoded by their index, Error for
+# announced routes in none of the validity states, e.g., as validation failed
+ARCHIVE_STATES = VALIDITY_STATES + ['withdraw', 'Error']
+
+def parse_prefix(prefix):
+    """
+    Returns (ip version, network as integer, prefix length) of an IP prefix
+    """
+    network, masklen = prefix.strip().split('/')
+    if ':' in network:
+        version = 6
+        family = socket.AF_INET6
+    else:
+        version = 4
+        family = socket.AF_INET
+    value = int(hexlify(socket.inet_pton(family, network)), 16)
+    return version, value, int(masklen)
+
+def _parse_asn(asn):
+    """
+    Returns AS number as integer, accepts 65000, '65000' and 'AS65000'
+    """
+    asn = str(asn).strip()
+    if asn.upper().startswith('AS'):
+        asn = asn[2:]
+    return int(asn)
+
+class PrefixTrie(object):
+    """
+    Binary trie over the prefixes of one address family. Nodes live in
+    parallel arrays indexed by node id, node 0 is the root and 0 doubles as
+    'no child'. Each node holds a list of items or None.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self.children = [array('l', [0]), array('l', [0])]
+        self.items = [None]
+
+    def __len__(self):
+        return len(self.items)
+
+    def _find(self, value, length, create=False):
+        """
+        Returns node id of prefix (value, length), or None if not present
+        """
+        node = 0
+        for pos in range(length):
+            bit = (value >> (self.bits - 1 - pos)) & 1
+            child = self.children[bit][node]
+            if child == 0:
+                if not create:
+                    return None
+                child = len(self.items)
+                self.children[0].append(0)
+                self.children[1].append(0)
+                self.items.append(None)
+                self.children[bit][node] = child
+            node = child
+        return node
+
+    def insert(self, value, length, item):
+        node = self._find(value, length, True)
+        if self.items[node] is None:
+            self.items[node] = [item]
+        else:
+            self.items[node].append(item)
+
+    def remove(self, value, length, item):
+        """
+        Remove item from prefix (value, length), nodes are kept for reuse
+        """
+        node = self._find(value, length)
+        if node is None or self.items[node] is None or item not in self.items[node]:
+            return False
+        self.items[node].remove(item)
+        if len(self.items[node]) == 0:
+            self.items[node] = None
+        return True
+
+    def covering(self, value, length):
+        """
+        Returns all items on prefixes covering (value, length), inclusive
+        """
+        result = list()
+        node = 0
+        pos = 0
+        while True:
+            if self.items[node] is not None:
+                result.extend(self.items[node])
+            if pos >= length:
+                break
+            bit = (value >> (self.bits - 1 - pos)) & 1
+            node = self.children[bit][node]
+            if node == 0:
+                break
+            pos += 1
+        return result
+
+    def covered(self, value, length):
+        """
+        Returns all items on prefixes covered by (value, length), inclusive
+        """
+        result = list()
+        node = self._find(value, length)
+        if node is None:
+            return result
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if self.items[node] is not None:
+                result.extend(self.items[node])
+            for bit in (0, 1):
+                child = self.children[bit][node]
+                if child != 0:
+                    stack.append(child)
+        return result
+
+def load_vrps(path):
+    """
+    Load a VRP dump, either JSON ({"roas": [{"asn", "prefix", "maxLength"}]},
+    as exported by common RPKI validators) or CSV (ASN,IP Prefix,Max Length),
+    returns a set of (asn, prefix, max_length) tuples.
+    """
+    vrps = set()
+    if path.endswith('.json'):
+        with open(path) as vrp_file:
+            data = json.load(vrp_file)
+        for roa in data['roas']:
+            prefix = roa['prefix']
+            max_length = roa.get('maxLength', prefix.split('/')[1])
+            vrps.add((_parse_asn(roa['asn']), prefix, int(max_length)))
+    else:
+        with open(path) as vrp_file:
+            for row in csv.reader(vrp_file):
+                if len(row) < 3 or row[0].strip().upper() == 'ASN':
+                    continue
+                vrps.add((_parse_asn(row[0]), row[1].strip(), int(row[2])))
+    return vrps
+
+class VRPTable(object):
+    """
+    The VRP set, loaded from a VRP dump file which is re-read whenever it
+    changes. Each change increments the serial, like an RTR cache would.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.mtime = None
+        self.serial = 0
+        self.vrps = set()
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        if path is not None:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.vrps)
+
+    def _add(self, vrp):
+        version, value, length = parse_prefix(vrp[1])
+        self.tries[version].insert(value, length, vrp)
+
+    def _remove(self, vrp):
+        version, value, length = parse_prefix(vrp[1])
+        self.tries[version].remove(value, length, vrp)
+
+    def update(self, vrps):
+        """
+        Replace the VRP set, returns the (added, removed) VRPs
+        """
+        added = vrps - self.vrps
+        removed = self.vrps - vrps
+        for vrp in removed:
+            self._remove(vrp)
+        for vrp in added:
+            self._add(vrp)
+        self.vrps = vrps
+        if len(added) > 0 or len(removed) > 0:
+            self.serial += 1
+        return added, removed
+
+    def refresh(self):
+        """
+        Reload VRP file if it changed, returns (added, removed) or None
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return None
+            vrps = load_vrps(self.path)
+        except Exception as errmsg:
+            logging.exception("failed to load VRPs from " + self.path + ": " + str(errmsg))
+            return None
+        self.mtime = mtime
+        delta = self.update(vrps)
+        logging.info("loaded " + str(len(self.vrps)) + " VRPs, serial " + str(self.serial))
+        return delta
+
+    def validate(self, prefix, asn):
+        """
+        RFC 6811 origin validation, returns the cli-validator result code
+        (0 = valid, 1 = not found, 2 = invalid) and the covering VRPs as
+        (asn, prefix, length, max length) string tuples.
+        """
+        version, value, length = parse_prefix(prefix)
+        origin = _parse_asn(asn)
+        code = 1
+        reasons = list()
+        for vrp in self.tries[version].covering(value, length):
+            if code != 0:
+                if vrp[0] == origin and length <= vrp[2]:
+                    code = 0
+                else:
+                    code = 2
+            reasons.append((str(vrp[0]), vrp[1].split('/')[0],
+                            vrp[1].split('/')[1], str(vrp[2])))
+        return code, reasons
+
+class RouteTable(object):
+    """
+    Currently announced routes, (origin, timestamp) per prefix and BGP peer,
+    i.e., an announcement replaces the route of its peer whatever the origin,
+    indexed to find all routes covered by a VRP prefix.
+    """
+    def __init__(self):
+        # prefix -> {source: (origin, timestamp)}
+        self.routes = dict()
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+
+    def __len__(self):
+        return len(self.routes)
+
+    def announce(self, prefix, origin, timestamp, source=None):
+        if prefix not in self.routes:
+            version, value, length = parse_prefix(prefix)
+            self.tries[version].insert(value, length, prefix)
+            self.routes[prefix] = dict()
+        self.routes[prefix][source] = (origin, timestamp)
+
+    def withdraw(self, prefix, source=None):
+        """
+        Remove the route of the peer
+        """
+        routes = self.routes.get(prefix)
+        if routes is None or routes.pop(source, None) is None:
+            return
+        if len(routes) == 0:
+            del self.routes[prefix]
+            version, value, length = parse_prefix(prefix)
+            self.tries[version].remove(value, length, prefix)
+
+    def covered(self, prefixes):
+        """
+        Returns (prefix, origin, timestamp, source) of all routes covered by
+        any of the given prefixes
+        """
+        found = set()
+        for prefix in prefixes:
+            version, value, length = parse_prefix(prefix)
+            found.update(self.tries[version].covered(value, length))
+        return [(prefix,) + route + (source,) for prefix in found
+                for source, route in self.routes[prefix].items()]
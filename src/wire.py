@@ -0,0 +1,104 @@
+"""
+Encoding of the records passed between the backend stages via STDOUT and
+STDIN: either JSON lines (default, easy to debug) or msgpack frames, each
+holding many records and prefixed by its length as 4 byte unsigned integer.
+"""
+import json
+import logging
+import struct
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from settings import WIRE_FRAME_RECORDS, WIRE_FLUSH_INTERVAL
+
+WIRE_FORMATS = ['json', 'msgpack']
+
+def _binary(stream):
+    """ underlying binary stream of a text stream (Python 3) """
+    return getattr(stream, 'buffer', stream)
+
+def _check_format(wire_format):
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError('Invalid wire format: ' + wire_format)
+    if wire_format == 'msgpack' and msgpack is None:
+        raise ValueError('Wire format msgpack requires the msgpack package.')
+
+class WireWriter(object):
+    """
+    Write records to a stream, msgpack frames are written once they hold
+    WIRE_FRAME_RECORDS records or are older than WIRE_FLUSH_INTERVAL seconds.
+    JSON lines are flushed one by one, unless autoflush is disabled.
+    """
+    def __init__(self, stream, wire_format='json', pretty=False, autoflush=True):
+        _check_format(wire_format)
+        self.stream = stream
+        self.wire_format = wire_format
+        self.pretty = pretty
+        self.autoflush = autoflush
+        self.batch = list()
+        self.begin = time.time()
+
+    def write(self, record):
+        if self.wire_format == 'json':
+            if record == 'STOP':
+                self.stream.write(record + '\n')
+            elif self.pretty:
+                self.stream.write(json.dumps(record, sort_keys=True, indent=2,
+                                             separators=(',', ': ')) + '\n')
+            else:
+                self.stream.write(json.dumps(record) + '\n')
+            if self.autoflush:
+                self.stream.flush()
+            return
+        if len(self.batch) == 0:
+            self.begin = time.time()
+        self.batch.append(record)
+        if (record == 'STOP') or (len(self.batch) >= WIRE_FRAME_RECORDS) or \
+                (time.time() - self.begin > WIRE_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) > 0:
+            frame = msgpack.packb(self.batch, use_bin_type=True)
+            stream = _binary(self.stream)
+            stream.write(struct.pack('!I', len(frame)))
+            stream.write(frame)
+            self.batch = list()
+        self.stream.flush()
+
+class WireReader(object):
+    """
+    Iterate over the records of a stream, stops at end of stream
+    """
+    def __init__(self, stream, wire_format='json'):
+        _check_format(wire_format)
+        self.stream = stream
+        self.wire_format = wire_format
+
+    def __iter__(self):
+        if self.wire_format == 'json':
+            # readline instead of line iteration, which reads ahead in Python 2
+            for line in iter(self.stream.readline, ''):
+                line = line.strip()
+                if line == 'STOP':
+                    yield line
+                    continue
+                try:
+                    record = json.loads(line, strict=False)
+                except ValueError:
+                    logging.exception("Failed to parse JSON from input.")
+                else:
+                    yield record
+            return
+        stream = _binary(self.stream)
+        while True:
+            header = stream.read(4)
+            if len(header) < 4:
+                return
+            frame = stream.read(struct.unpack('!I', header)[0])
+            for record in msgpack.unpackb(frame, raw=False):
+                yield record
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the backend modules are imported from src, as done by the tools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
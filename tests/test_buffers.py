@@ -0,0 +1,89 @@
+"""
+Policies of the bounded buffers between the stages of the backend, backed
+by a thread queue instead of a multiprocessing one
+"""
+import threading
+import time
+
+import pytest
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from buffers import StageBuffer
+
+def _buffer(size, policy='block', key=None, **kwargs):
+    return StageBuffer('test', size, policy, key=key, queue=Queue(size), **kwargs)
+
+def _read(buf, count):
+    reader = buf.reader()
+    return [reader.get(timeout=5) for _ in range(count)]
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        _buffer(1, 'unknown')
+    with pytest.raises(ValueError):
+        _buffer(1, 'coalesce')
+
+def test_block_waits_for_consumer():
+    buf = _buffer(1)
+    buf.put(1)
+    consumer = threading.Timer(0.2, buf.reader().get)
+    consumer.start()
+    buf.put(2)
+    consumer.join()
+    assert buf.counters['blocked'] == 1
+    assert _read(buf, 1) == [2]
+    assert buf.hwm == 1
+
+def test_drop_oldest():
+    buf = _buffer(2, 'drop-oldest')
+    for item in range(5):
+        buf.put(item)
+    assert _read(buf, 2) == [3, 4]
+    assert buf.counters['dropped'] == 3
+    assert buf.stats()['put'] == 5
+
+def test_drop_oldest_keeps_kept_records():
+    buf = _buffer(2, 'drop-oldest')
+    buf.put('rib', keep=True)
+    assert _read(buf, 1) == ['rib']
+    # records put after a kept one are queued behind it, they block as well
+    buf.put(1)
+    buf.put(2)
+    buf.put(3)
+    assert _read(buf, 2) == [2, 3]
+    assert buf.counters['dropped'] == 1
+
+def test_coalesce_keeps_latest_record_per_key():
+    buf = _buffer(2, 'coalesce', key=lambda item: item[0])
+    for item in [('a', 1), ('b', 1), ('b', 2), ('a', 2), ('a', 3)]:
+        buf.put(item)
+    assert buf.counters['coalesced'] == 1
+    assert buf.depth() == 4
+    assert _read(buf, 4) == [('a', 1), ('b', 1), ('b', 2), ('a', 3)]
+
+def test_spill_keeps_all_records_in_order(tmp_path):
+    buf = _buffer(1, 'spill', spill_dir=str(tmp_path))
+    for item in range(5):
+        buf.put({'seq': item})
+    assert buf.counters['spilled'] == 4
+    assert _read(buf, 5) == [{'seq': item} for item in range(5)]
+    buf.put('STOP')
+    assert _read(buf, 1) == ['STOP']
+    assert len(buf.overflow) == 0
+
+def test_reader_poll_and_recv():
+    buf = _buffer(2)
+    reader = buf.reader()
+    assert not reader.poll()
+    buf.put(1)
+    assert reader.poll(1)
+    assert reader.poll()
+    assert reader.recv() == 1
+    threading.Timer(0.1, buf.put, [2]).start()
+    begin = time.time()
+    assert reader.recv() == 2
+    assert time.time() - begin < 5
@@ -0,0 +1,110 @@
+"""
+Latest state of routes in validity_latest and the counters derived from it,
+written to an in-memory MongoDB (mongomock)
+"""
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from mongodb import ValidityWriter, StatsEngine, OriginWriter
+from vrptable import RouteTable
+
+PREFIX = '10.0.0.0/8'
+
+def _announcement(origin, state, timestamp, source='192.0.2.1'):
+    return {
+        'type': 'announcement',
+        'prefix': PREFIX,
+        'timestamp': timestamp,
+        'source': source,
+        'validated_route': {
+            'route': {'origin_asn': origin, 'prefix': PREFIX},
+            'validity': {'state': state, 'code': 0, 'VRPs': {}}
+        }
+    }
+
+def _withdraw(timestamp, source='192.0.2.1'):
+    return {'type': 'withdraw', 'prefix': PREFIX, 'timestamp': timestamp, 'source': source}
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient().db
+
+def _write(database, engine, per_peer, *bulks):
+    writer = ValidityWriter(database, per_peer=per_peer, engine=engine)
+    for bulk in bulks:
+        for data in bulk:
+            writer.add(data)
+        writer.flush()
+
+def _get_latest(database):
+    return dict((doc['origin'], doc['value']['type'])
+                for doc in database.validity_latest.find({'prefix': PREFIX}))
+
+def _get_announced(database):
+    return sorted(origin for origin, value_type in _get_latest(database).items()
+                  if value_type == 'announcement')
+
+@pytest.mark.parametrize('per_peer', [False, True])
+@pytest.mark.parametrize('same_bulk', [False, True])
+def test_origin_change_releases_previous_origin(database, per_peer, same_bulk):
+    engine = StatsEngine(0, summaries=OriginWriter(database))
+    bulks = [[_announcement('AS666', 'InvalidAS', 100)],
+             [_announcement('AS65000', 'Valid', 200)]]
+    if same_bulk:
+        bulks = [bulks[0] + bulks[1]]
+    _write(database, engine, per_peer, *bulks)
+    assert _get_announced(database) == ['AS65000']
+    stats = engine.get_stats()
+    assert stats['num_Valid'] == 1
+    assert stats['num_InvalidAS'] == 0
+    assert engine.rollup['ipv4']['len_Valid'][8] == 1
+    assert engine.rollup['ipv4']['len_InvalidAS'][8] == 0
+    assert database.origin_summary.find_one({'_id': 'AS666'}) is None
+    assert database.origin_summary.find_one({'_id': 'AS65000'})['num_Valid'] == 1
+
+def test_origin_of_other_peer_is_kept(database):
+    engine = StatsEngine(0)
+    _write(database, engine, False,
+           [_announcement('AS666', 'InvalidAS', 100, '192.0.2.2'),
+            _announcement('AS666', 'InvalidAS', 100)],
+           [_announcement('AS65000', 'Valid', 200)])
+    assert _get_latest(database) == {'AS666': 'announcement', 'AS65000': 'announcement'}
+    _write(database, engine, False, [_withdraw(300, '192.0.2.2')])
+    assert _get_latest(database) == {'AS666': 'withdraw', 'AS65000': 'announcement'}
+    stats = engine.get_stats()
+    assert (stats['num_Valid'], stats['num_InvalidAS']) == (1, 0)
+
+def test_withdraw_removes_route_of_peer_only(database):
+    engine = StatsEngine(0)
+    _write(database, engine, False,
+           [_announcement('AS65000', 'Valid', 100),
+            _announcement('AS65000', 'Valid', 100, '192.0.2.2')],
+           [_withdraw(200)])
+    assert _get_latest(database) == {'AS65000': 'announcement'}
+    _write(database, engine, False, [_withdraw(300, '192.0.2.2')])
+    assert _get_latest(database) == {'AS65000': 'withdraw'}
+    assert engine.get_stats()['num_Valid'] == 0
+
+def test_results_of_previous_versions_are_released(database):
+    database.validity_latest.insert_one(
+        {'_id': PREFIX + ' AS666', 'prefix': PREFIX, 'origin': 'AS666',
+         'value': {'type': 'announcement', 'timestamp': 100,
+                   'validated_route': _announcement('AS666', 'InvalidAS', 100)['validated_route']}})
+    engine = StatsEngine(0)
+    _write(database, engine, False, [_announcement('AS65000', 'Valid', 200)])
+    assert _get_latest(database) == {'AS666': 'withdraw', 'AS65000': 'announcement'}
+    assert engine.get_stats()['num_InvalidAS'] == 0
+
+def test_route_table_replaces_route_of_peer():
+    table = RouteTable()
+    table.announce(PREFIX, '666', 100, 'P1')
+    table.announce(PREFIX, '666', 100, 'P2')
+    table.announce(PREFIX, '65000', 200, 'P1')
+    assert sorted(table.covered([PREFIX])) == [(PREFIX, '65000', 200, 'P1'),
+                                                (PREFIX, '666', 100, 'P2')]
+    table.withdraw(PREFIX, 'P2')
+    assert table.covered([PREFIX]) == [(PREFIX, '65000', 200, 'P1')]
+    table.withdraw(PREFIX, 'P1')
+    assert len(table) == 0
+    assert table.covered(['10.0.0.0/7']) == []
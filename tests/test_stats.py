@@ -0,0 +1,117 @@
+"""
+State transitions of the stats engine, fed as from a change stream, and the
+archive of transitions written from them, in an in-memory MongoDB (mongomock)
+"""
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from mongodb import ArchiveWriter, OriginWriter, StatsEngine
+from vrptable import ARCHIVE_STATES
+
+PREFIX = '10.0.0.0/8'
+# 2023-11-14 22:13:20 UTC
+TS = 1700000000
+MONTH = 1698796800
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient().db
+
+def _doc(origin, peer, state, timestamp):
+    value = {'type': 'withdraw', 'timestamp': timestamp}
+    if state is not None:
+        value = {'type': 'announcement', 'timestamp': timestamp,
+                 'validated_route': {'validity': {'state': state}}}
+    return {'prefix': PREFIX, 'origin': origin, 'peer': peer, 'value': value}
+
+def _change(origin, peer, state, timestamp):
+    return {'operationType': 'update', 'fullDocument': _doc(origin, peer, state, timestamp)}
+
+def _get_archive(database):
+    """Decode the archive like the frontend, (origin, timestamp, state)"""
+    events = list()
+    for doc in database.validity_archive.find({'prefix': PREFIX}):
+        events.extend((doc['origin'], doc['base'] + (event >> 3), ARCHIVE_STATES[event & 7])
+                      for event in doc['e'])
+    return sorted(events, key=lambda event: (event[1], event[0]))
+
+def _counts(engine):
+    stats = engine.get_stats()
+    return dict((key, value) for key, value in stats.items() if value and key != 'ts')
+
+def test_state_transitions(database):
+    engine = StatsEngine(0, archive=ArchiveWriter(database),
+                         summaries=OriginWriter(database))
+    lengths = engine.rollup['ipv4']
+    engine.apply_change(_change('AS666', 'P1', 'InvalidAS', TS))
+    assert _counts(engine) == {'num_InvalidAS': 1}
+    assert lengths['len_InvalidAS'][8] == 1
+    engine.apply_change(_change('AS65000', 'P2', 'Valid', TS + 10))
+    assert _counts(engine) == {'num_InvalidAS': 1, 'num_Valid': 1}
+    # the prefix is counted once, in its best state
+    assert (lengths['len_Valid'][8], lengths['len_InvalidAS'][8]) == (1, 0)
+    engine.flush()
+    assert database.origin_summary.find_one({'_id': 'AS666'})['invalid'] == [
+        {'prefix': PREFIX, 'state': 'InvalidAS'}]
+    # failed validations are not counted
+    engine.apply_change(_change('AS666', 'P1', 'Error', TS + 20))
+    assert _counts(engine) == {'num_Valid': 1}
+    engine.apply_change(_change('AS666', 'P1', None, TS + 30))
+    assert _counts(engine) == {'num_Valid': 1}
+    engine.apply_change({'operationType': 'delete',
+                         'documentKey': {'_id': PREFIX + ' AS65000 P2'}})
+    assert _counts(engine) == {}
+    assert lengths['len_Valid'][8] == 0
+    # withdrawn routes are kept, like their results in validity_latest
+    assert engine.prefixes[PREFIX] == {('AS666', 'P1'): (None, TS + 30)}
+    engine.flush()
+    assert database.origin_summary.count_documents({}) == 0
+    assert _get_archive(database) == [('AS666', TS, 'InvalidAS'),
+                                      ('AS65000', TS + 10, 'Valid'),
+                                      ('AS666', TS + 20, 'Error'),
+                                      ('AS65000', TS + 30, 'withdraw'),
+                                      ('AS666', TS + 30, 'withdraw')]
+
+def test_origin_state_is_best_of_its_routes(database):
+    engine = StatsEngine(0, archive=ArchiveWriter(database))
+    engine.apply_change(_change('AS65000', 'P1', 'InvalidLength', TS))
+    engine.apply_change(_change('AS65000', 'P2', 'Valid', TS + 10))
+    # no transition of the prefix and origin
+    engine.apply_change(_change('AS65000', 'P1', 'NotFound', TS + 20))
+    engine.apply_change(_change('AS65000', 'P2', None, TS + 30))
+    engine.flush()
+    assert _counts(engine) == {'num_NotFound': 1}
+    assert _get_archive(database) == [('AS65000', TS, 'InvalidLength'),
+                                      ('AS65000', TS + 10, 'Valid'),
+                                      ('AS65000', TS + 30, 'NotFound')]
+
+def test_archive_round_trip(database):
+    archive = ArchiveWriter(database, max_ops=2)
+    transitions = [('AS65000', MONTH, 'Valid'),
+                   ('AS65000', TS, 'Error'),
+                   ('AS65000', MONTH - 1, None),
+                   ('AS666', TS, 'InvalidAS')]
+    for origin, timestamp, state in transitions:
+        archive.add(PREFIX, origin, state, timestamp)
+    archive.flush()
+    assert sorted(doc['base'] for doc in database.validity_archive.find()) == \
+        [MONTH - 31*24*3600, MONTH, MONTH]
+    assert sorted(_get_archive(database)) == sorted(
+        (origin, timestamp, state or 'withdraw') for origin, timestamp, state in transitions)
+
+def test_checkpoint(database):
+    engine = StatsEngine(0, series=False)
+    engine.checkpoint(database)
+    assert database.validity_rollup.count_documents({}) == 0
+    engine.apply_change(_change('AS65000', 'P1', 'Valid', TS))
+    engine.checkpoint(database)
+    rollup = database.validity_rollup.find_one({'_id': 'ipversion'})
+    assert rollup['ts'] == TS
+    assert rollup['ipv4']['num_Valid'] == 1
+    assert database.validity_stats.count_documents({}) == 0
+    engine = StatsEngine(0, rollup=False)
+    engine.apply_change(_change('AS65000', 'P1', 'NotFound', TS + 10))
+    engine.checkpoint(database)
+    assert database.validity_rollup.find_one({'_id': 'ipversion'})['ts'] == TS
+    assert database.validity_stats.count_documents({}) > 0
@@ -0,0 +1,63 @@
+"""
+Expiry, eviction and invalidation of cached validation results
+"""
+import time
+
+from validationcache import ValidationCache
+
+VALID = {'state': 'Valid'}
+
+def test_lru_eviction():
+    cache = ValidationCache(2)
+    cache.put('10.0.0.0/8', '65000', VALID)
+    cache.put('10.1.0.0/16', '65000', VALID)
+    assert cache.get('10.0.0.0/8', '65000') == VALID
+    cache.put('10.2.0.0/16', '65000', VALID)
+    assert len(cache) == 2
+    assert cache.get('10.1.0.0/16', '65000') is None
+    assert cache.get('10.0.0.0/8', '65000') == VALID
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 1, 'hit_ratio': 66.67}
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache = ValidationCache(10, ttl=60)
+    cache.put('10.0.0.0/8', '65000', VALID)
+    now[0] += 59
+    assert cache.get('10.0.0.0/8', '65000') == VALID
+    now[0] += 2
+    assert cache.get('10.0.0.0/8', '65000') is None
+    # expired entries are dropped on lookup
+    assert len(cache) == 0
+
+def test_no_expiry_without_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache = ValidationCache(10)
+    cache.put('10.0.0.0/8', '65000', VALID)
+    now[0] += 365*24*3600
+    assert cache.get('10.0.0.0/8', '65000') == VALID
+
+def test_sync_invalidates_covered_entries():
+    cache = ValidationCache(10)
+    cache.sync(1)
+    cache.put('10.1.0.0/16', '65000', VALID)
+    cache.put('10.2.0.0/16', '65000', VALID)
+    cache.put('2001:db8::/32', '65000', VALID)
+    cache.put('192.0.2.0/24', '65000', VALID)
+    # same serial, nothing changed
+    cache.sync(1, ['10.0.0.0/8'])
+    assert len(cache) == 4
+    cache.sync(2, ['10.1.0.0/16', '2001:db8::/29'])
+    assert cache.serial == 2
+    assert sorted(key[0] for key in cache.entries) == ['10.2.0.0/16', '192.0.2.0/24']
+    # unknown changes drop all entries
+    cache.sync(3)
+    assert len(cache) == 0
+
+def test_first_sync_clears_cache():
+    cache = ValidationCache(10)
+    cache.put('10.1.0.0/16', '65000', VALID)
+    cache.sync(5, ['192.0.2.0/24'])
+    assert len(cache) == 0
+    assert cache.serial == 5
@@ -0,0 +1,242 @@
+"""
+Validation sessions, against a fake cli-validator and an in-process VRP
+table, and the coalescing of BGP updates
+"""
+import os
+import stat
+import sys
+
+import pytest
+
+import validator
+from validationcache import ValidationCache
+from validator import ValidationSession, VRPSession, UpdateCoalescer
+from vrptable import VRPTable
+
+# answers queries like the cli-validator for a VRP 10.0.0.0/8-16 of AS65000,
+# AS13 gets an error response, which does not echo the query. Modes, given as
+# cache port: 'reverse' answers pairs of queries in reverse order, 'die' exits
+# on a query of AS13 unless the marker file, given as cache host, exists
+FAKE_VALIDATOR = """#!%s
+import os
+import sys
+
+marker, mode = sys.argv[1], sys.argv[2]
+pending = []
+for line in iter(sys.stdin.readline, ''):
+    query = line.strip()
+    network, masklen, asn = query.split()
+    if asn == '13':
+        if mode == 'die' and not os.path.exists(marker):
+            open(marker, 'w').close()
+            sys.exit(1)
+        pending.append('error')
+    elif not network.startswith('10.'):
+        pending.append(query + '||1')
+    elif asn == '65000' and int(masklen) <= 16:
+        pending.append(query + '|65000 10.0.0.0 8 16|0')
+    else:
+        pending.append(query + '|65000 10.0.0.0 8 16|2')
+    if mode == 'reverse' and len(pending) < 2:
+        continue
+    for response in reversed(pending):
+        sys.stdout.write(response + '\\n')
+    sys.stdout.flush()
+    pending = []
+"""
+
+@pytest.fixture
+def fake_validator(tmp_path, monkeypatch):
+    path = tmp_path / 'cli-validator'
+    path.write_text(FAKE_VALIDATOR % sys.executable)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(validator, 'VALIDATOR_PATH', str(path))
+    return str(tmp_path / 'died')
+
+def _entry(prefix, origin, timestamp=100, source='192.0.2.1', rib=False):
+    return (prefix, origin, timestamp, source, rib)
+
+def _withdraw(prefix, timestamp=100, source='192.0.2.1'):
+    return {'type': 'withdraw', 'prefix': prefix, 'timestamp': timestamp, 'source': source}
+
+def _run(session, entries):
+    """Dispatch entries and collect the records of the session"""
+    records = list()
+    for entry in entries:
+        validator._dispatch(session, entry)
+        records.extend(session.completed())
+    while not session.idle():
+        session.receive()
+        records.extend(session.completed())
+    return records
+
+def _states(records):
+    return [(record['prefix'], record['validated_route']['validity']['state'])
+            if record['type'] == 'announcement' else (record['prefix'], 'withdraw')
+            for record in records]
+
+def test_validation_session_keeps_input_order(fake_validator):
+    session = ValidationSession(fake_validator, 'reverse', 10)
+    try:
+        records = _run(session, [_entry('10.1.0.0/16', '65000'),
+                                 _entry('10.1.0.0/24', '65000'),
+                                 _withdraw('10.2.0.0/16'),
+                                 _entry('10.1.0.0/16', '666'),
+                                 _entry('192.0.2.0/24', '65000')])
+    finally:
+        session.close()
+    assert _states(records) == [('10.1.0.0/16', 'Valid'),
+                                ('10.1.0.0/24', 'InvalidLength'),
+                                ('10.2.0.0/16', 'withdraw'),
+                                ('10.1.0.0/16', 'InvalidAS'),
+                                ('192.0.2.0/24', 'NotFound')]
+    assert records[0]['source'] == '192.0.2.1'
+    assert records[0]['validated_route']['route']['origin_asn'] == 'AS65000'
+
+def test_validation_session_matches_duplicate_queries(fake_validator):
+    session = ValidationSession(fake_validator, 'reverse', 10)
+    try:
+        records = _run(session, [_entry('10.1.0.0/16', '65000', 100),
+                                 _entry('10.1.0.0/16', '65000', 200)])
+    finally:
+        session.close()
+    assert [record['timestamp'] for record in records] == [100, 200]
+
+def test_validation_session_blames_error_on_oldest_query(fake_validator):
+    session = ValidationSession(fake_validator, 'ordered', 10)
+    try:
+        records = _run(session, [_entry('10.1.0.0/16', '13'),
+                                 _entry('10.1.0.0/16', '65000')])
+    finally:
+        session.close()
+    assert _states(records) == [('10.1.0.0/16', 'Error'), ('10.1.0.0/16', 'Valid')]
+    assert records[0]['validated_route']['validity']['code'] == 101
+
+def test_validation_session_resends_queries_on_restart(fake_validator):
+    session = ValidationSession(fake_validator, 'die', 10)
+    first = session.process
+    try:
+        records = _run(session, [_entry('10.1.0.0/16', '65000'),
+                                 _entry('10.1.0.0/16', '13'),
+                                 _entry('10.1.0.0/24', '666')])
+    finally:
+        session.close()
+    assert os.path.exists(fake_validator)
+    assert first.returncode is not None
+    assert _states(records) == [('10.1.0.0/16', 'Valid'),
+                                ('10.1.0.0/16', 'Error'),
+                                ('10.1.0.0/24', 'InvalidAS')]
+
+def test_validation_session_answers_from_cache(fake_validator):
+    cache = ValidationCache(10)
+    session = ValidationSession(fake_validator, 'ordered', 10, cache)
+    try:
+        first = _run(session, [_entry('10.1.0.0/16', '65000', 100)])
+        session.process.stdin.close()
+        # the process is not asked again, its input is closed
+        second = _run(session, [_entry('10.1.0.0/16', '65000', 200)])
+    finally:
+        session.close()
+    assert _states(first + second) == [('10.1.0.0/16', 'Valid'), ('10.1.0.0/16', 'Valid')]
+    assert second[0]['timestamp'] == 200
+    assert cache.hits == 1
+
+def _write_vrps(path, rows, mtime):
+    path.write_text('ASN,IP Prefix,Max Length\n' +
+                    ''.join(','.join(str(field) for field in row) + '\n' for row in rows))
+    os.utime(str(path), (mtime, mtime))
+
+@pytest.fixture
+def vrp_file(tmp_path):
+    path = tmp_path / 'vrps.csv'
+    _write_vrps(path, [('AS65000', '10.0.0.0/8', 16)], 1000)
+    return path
+
+def test_vrp_session_validates(vrp_file):
+    session = VRPSession(VRPTable(str(vrp_file)), 10)
+    records = _run(session, [_entry('10.1.0.0/16', '65000'),
+                             _entry('10.1.0.0/24', '65000'),
+                             _entry('10.1.0.0/16', '666'),
+                             _entry('192.0.2.0/24', '65000'),
+                             _withdraw('10.1.0.0/16')])
+    assert _states(records) == [('10.1.0.0/16', 'Valid'),
+                                ('10.1.0.0/24', 'InvalidLength'),
+                                ('10.1.0.0/16', 'InvalidAS'),
+                                ('192.0.2.0/24', 'NotFound'),
+                                ('10.1.0.0/16', 'withdraw')]
+    validity = records[1]['validated_route']['validity']
+    assert validity['VRPs']['unmatched_length'] == [
+        {'asn': 'AS65000', 'prefix': '10.0.0.0/8', 'max_length': '16'}]
+
+def test_vrp_session_revalidates_covered_routes(vrp_file):
+    cache = ValidationCache(10)
+    session = VRPSession(VRPTable(str(vrp_file)), 10, cache)
+    _run(session, [_entry('10.1.0.0/24', '65000', 100, 'P1'),
+                   _entry('10.2.0.0/24', '65000', 100, 'P1'),
+                   _entry('10.2.0.0/24', '65000', 100, 'P2'),
+                   _withdraw('10.2.0.0/24', 200, 'P1'),
+                   _entry('192.0.2.0/24', '65000', 100, 'P1')])
+    _write_vrps(vrp_file, [('AS65000', '10.0.0.0/8', 24)], 2000)
+    session.last_refresh = 0
+    delta = session.refresh()
+    assert delta is not None
+    records = sorted(session.completed(), key=lambda record: (record['prefix'],
+                                                              record['source']))
+    assert _states(records) == [('10.1.0.0/24', 'Valid'), ('10.2.0.0/24', 'Valid')]
+    assert [record['source'] for record in records] == ['P1', 'P2']
+    # BGP timestamps are kept, such that later updates supersede the results
+    assert all(record['timestamp'] == 100 and 'revalidated' in record
+               for record in records)
+    assert cache.serial == session.vrp_table.serial
+    assert cache.get('10.1.0.0/24', '65000')['state'] == 'Valid'
+    # unchanged file, nothing to do
+    session.last_refresh = 0
+    assert session.refresh() is None
+
+def test_coalescer_keeps_latest_entry_of_peer():
+    coalescer = UpdateCoalescer(0)
+    assert coalescer.add(_entry('10.0.0.0/8', '666', 100, 'P1')) == []
+    assert coalescer.add(_entry('10.0.0.0/8', '65000', 100, 'P2')) == []
+    assert coalescer.add(_entry('10.0.0.0/8', '65000', 200, 'P1')) == []
+    assert coalescer.add(_withdraw('10.0.0.0/8', 300, 'P2')) == []
+    assert coalescer.superseded == 2
+    assert list(coalescer.drain()) == [_entry('10.0.0.0/8', '65000', 200, 'P1'),
+                                       _withdraw('10.0.0.0/8', 300, 'P2')]
+
+def test_coalescer_holds_entries_for_window():
+    coalescer = UpdateCoalescer(60)
+    coalescer.add(_entry('10.0.0.0/8', '65000'))
+    assert coalescer.pop_due() is None
+    assert 59 < coalescer.wait() <= 60
+    coalescer = UpdateCoalescer(0)
+    coalescer.add(_entry('10.0.0.0/8', '65000'))
+    assert coalescer.pop_due() == _entry('10.0.0.0/8', '65000')
+    assert len(coalescer) == 0
+    assert coalescer.pop_due() is None
+
+def test_coalescer_passes_rib_entries():
+    coalescer = UpdateCoalescer(60)
+    coalescer.add(_entry('10.0.0.0/8', '666', 100, 'P1'))
+    coalescer.add(_entry('10.0.0.0/8', '666', 100, 'P2'))
+    rib = _entry('10.0.0.0/8', '65000', 200, 'P1', True)
+    assert coalescer.add(rib) == [_entry('10.0.0.0/8', '666', 100, 'P1'), rib]
+    assert coalescer.add(rib) == [rib]
+    assert coalescer.superseded == 0
+    assert list(coalescer.drain()) == [_entry('10.0.0.0/8', '666', 100, 'P2')]
+
+def test_coalescer_moas_keeps_origins():
+    coalescer = UpdateCoalescer(0, moas=True)
+    coalescer.add(_entry('10.0.0.0/8', '666', 100))
+    coalescer.add(_entry('10.0.0.0/8', '65000', 200))
+    coalescer.add(_entry('10.0.0.0/8', '666', 300))
+    assert coalescer.superseded == 1
+    # the latest entry of the peer is dispatched last
+    assert list(coalescer.drain()) == [_entry('10.0.0.0/8', '65000', 200),
+                                       _entry('10.0.0.0/8', '666', 300)]
+    coalescer.add(_entry('10.0.0.0/8', '666', 100))
+    coalescer.add(_entry('10.0.0.0/8', '65000', 200))
+    coalescer.add(_entry('10.0.0.0/8', '65000', 200, 'P2'))
+    coalescer.add(_withdraw('10.0.0.0/8', 300))
+    assert coalescer.superseded == 3
+    assert list(coalescer.drain()) == [_entry('10.0.0.0/8', '65000', 200, 'P2'),
+                                       _withdraw('10.0.0.0/8', 300)]